@@ -1,11 +1,337 @@
-import sys, os, cv2, numpy as np
+import sys, os, io, cv2, zlib, hashlib, tempfile, threading, numpy as np
+from collections import OrderedDict, deque
+from functools import lru_cache
 from PIL import Image
 import PyQt5.QtGui as QtGui
-from PyQt5.QtCore import Qt, QRect, QPoint, pyqtSignal, QSize
-from PyQt5.QtGui import QImage, QPixmap, QPainter, QColor, QIcon
+from PyQt5.QtCore import Qt, QRect, QPoint, pyqtSignal, QSize, QObject, QRunnable, QThreadPool, QStandardPaths, \
+    QAbstractListModel, QModelIndex, QFileSystemWatcher
+from PyQt5.QtGui import QImage, QPixmap, QPainter, QColor, QIcon, QKeySequence
 from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QSlider, \
-    QFileDialog, QLabel, QComboBox, QMessageBox, QListWidgetItem, QListWidget, QCheckBox, QGridLayout, QSpacerItem, \
-    QSizePolicy
+    QFileDialog, QLabel, QComboBox, QMessageBox, QCheckBox, QGridLayout, QSpacerItem, \
+    QSizePolicy, QListView, QStyledItemDelegate, QStyle, QStyleOptionButton, QShortcut, QProgressBar
+
+try:
+    from auto_labeling.guided import PSTLabeler, PSTResult, PSTResultCache, evict_lru
+except ImportError:  # the vessel assist tool needs semi_auto_labeling_lib to be installed
+    PSTLabeler = None
+    evict_lru = None
+
+
+class ThumbnailCache:
+    """On-disk thumbnail cache keyed by hash of the image file content.
+    When the cache grows over max_bytes the least recently used thumbnails are removed
+    (needs semi_auto_labeling_lib, without it the cache is not limited).
+    """
+
+    def __init__(self, folder, max_bytes=200 * 1024 * 1024):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.total_bytes = None
+        os.makedirs(self.folder, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.folder, key + ".jpg")
+
+    def get(self, key):
+        path = self.path(key)
+        image = QImage(path)
+        if image.isNull():
+            return None
+        try:
+            os.utime(path)  # modification time serves as last access for eviction
+        except OSError:
+            pass
+        return image
+
+    def put(self, key, image):
+        path = self.path(key)
+        old_bytes = os.path.getsize(path) if os.path.isfile(path) else 0
+        tmp_path = path + ".%d.tmp" % threading.get_ident()
+        if not image.save(tmp_path, "JPG", 85):
+            return
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(entry.stat().st_size for entry in os.scandir(self.folder)
+                                       if entry.name.endswith(".jpg") and entry.is_file())
+            else:
+                self.total_bytes += os.path.getsize(path) - old_bytes
+            if self.total_bytes > self.max_bytes and evict_lru is not None:
+                self.evict()
+
+    def evict(self):
+        self.total_bytes = evict_lru(self.folder, ".jpg", self.max_bytes)
+
+
+class ThumbnailTask(QRunnable):
+    def __init__(self, loader, path):
+        super().__init__()
+        self.loader = loader
+        self.path = path
+
+    def run(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+            key = hashlib.sha1(data).hexdigest() + "_%d" % self.loader.width
+            image = self.loader.cache.get(key)
+            if image is None:
+                image = self.decode(data)
+                self.loader.cache.put(key, image)
+        except Exception as e:
+            # an exception escaping QRunnable.run aborts the application, the placeholder is shown instead
+            if not isinstance(e, OSError):
+                print("Failed to create thumbnail of " + self.path + ": " + str(e))
+            image = QImage()
+        self.loader.ready.emit(self.path, image)
+
+    def decode(self, data):
+        width = self.loader.width
+        img = Image.open(io.BytesIO(data))
+        # draft lets the JPEG decoder skip DCT scales, the full resolution image is never decoded
+        img.draft("RGB", (width, max(img.height * width // img.width, 1)))
+        img = img.convert("RGB")
+        img.thumbnail((width, img.height))
+        rgb = img.tobytes()
+        return QImage(rgb, img.width, img.height, 3 * img.width, QtGui.QImage.Format_RGB888).copy()
+
+
+class ThumbnailLoader(QObject):
+    """Generates thumbnails in a worker pool, ready is emitted in the GUI thread for every requested path"""
+    ready = pyqtSignal(str, QImage)
+
+    def __init__(self, width=200, parent=None):
+        super().__init__(parent)
+        self.width = width
+        self.pool = QThreadPool(self)
+        folder = os.path.join(QStandardPaths.writableLocation(QStandardPaths.GenericCacheLocation),
+                              "OptiLabel", "thumbnails")
+        self.cache = ThumbnailCache(folder)
+
+    def request(self, path):
+        self.pool.start(ThumbnailTask(self, path))
+
+
+# name, mask folder, file suffix letter, overlay colour (BGR)
+LABEL_CLASSES = (
+    ("Vessel network", "VesselMasks", "V", (255, 255, 0)),
+    ("Macula", "Macula", "M", (128, 0, 128)),
+    ("Optical disk", "Optical", "O", (255, 0, 0)),
+)
+MASK_FOLDERS = tuple((folder, "_" + letter + ".png", letter) for _, folder, letter, _ in LABEL_CLASSES)
+
+
+class MaskIndex(QObject):
+    """In-memory index of existing mask files of every watched image folder.
+    Each mask folder is read with a single scandir and rescanned only when
+    QFileSystemWatcher reports a change in it.
+    """
+    changed = pyqtSignal(str, list)  # image folder, names of images whose status changed
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.folders = {}
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.on_directory_changed)
+
+    @staticmethod
+    def split(image_path):
+        folder = os.path.normpath(os.path.dirname(image_path))
+        return folder, os.path.splitext(os.path.basename(image_path))[0]
+
+    def scan(self, folder, subfolder, suffix):
+        names = set()
+        try:
+            with os.scandir(os.path.join(folder, subfolder)) as entries:
+                for entry in entries:
+                    if entry.name.endswith(suffix):
+                        names.add(entry.name[:-len(suffix)])
+        except OSError:
+            pass
+        return names
+
+    def watch(self, folder):
+        if folder in self.folders:
+            return
+        self.folders[folder] = {letter: self.scan(folder, subfolder, suffix) for subfolder, suffix, letter in MASK_FOLDERS}
+        self.watcher.addPath(folder)  # catches creation of the mask folders
+        for subfolder, _, _ in MASK_FOLDERS:
+            if os.path.isdir(os.path.join(folder, subfolder)):
+                self.watcher.addPath(os.path.join(folder, subfolder))
+
+    def rescan(self, folder, subfolder):
+        for name, suffix, letter in MASK_FOLDERS:
+            if name != subfolder:
+                continue
+            names = self.scan(folder, subfolder, suffix)
+            changed = names ^ self.folders[folder][letter]
+            self.folders[folder][letter] = names
+            if changed:
+                self.changed.emit(folder, list(changed))
+
+    def refresh(self, folder=None):
+        for watched in ([folder] if folder else list(self.folders)):
+            if watched in self.folders:
+                for subfolder, _, _ in MASK_FOLDERS:
+                    self.rescan(watched, subfolder)
+
+    def on_directory_changed(self, path):
+        path = os.path.normpath(path)
+        if path in self.folders:
+            # A mask folder may have been created or removed
+            watched = set(os.path.normpath(p) for p in self.watcher.directories())
+            for subfolder, _, _ in MASK_FOLDERS:
+                mask_folder = os.path.join(path, subfolder)
+                if mask_folder not in watched and os.path.isdir(mask_folder):
+                    self.watcher.addPath(mask_folder)
+                    self.rescan(path, subfolder)
+        else:
+            folder, subfolder = os.path.split(path)
+            if folder in self.folders:
+                self.rescan(folder, subfolder)
+
+    def status(self, image_path):
+        folder, name = self.split(image_path)
+        self.watch(folder)
+        status_text = [letter for _, _, letter in MASK_FOLDERS if name in self.folders[folder][letter]]
+        if status_text:
+            return "Masks: " + ", ".join(status_text)
+        return "No masks"
+
+
+class ImageListModel(QAbstractListModel):
+    """List of loaded images. Thumbnails and mask statuses are produced lazily,
+    only for rows the view actually asks for.
+    """
+    PathRole = Qt.UserRole + 1
+    StatusRole = Qt.UserRole + 2
+
+    def __init__(self, thumbnails, mask_index, max_thumbnails=512, parent=None):
+        super().__init__(parent)
+        self.paths = []
+        self.rows = {}
+        self.name_rows = {}
+        self.checked_row = None
+        self.mask_index = mask_index
+        self.mask_index.changed.connect(self.on_masks_changed)
+        self.thumbnails = thumbnails
+        self.thumbnails.ready.connect(self.on_thumbnail_ready)
+        self.max_thumbnails = max_thumbnails
+        self.pixmaps = OrderedDict()
+        self.requested = set()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.paths)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        path = self.paths[index.row()]
+
+        if role == Qt.DisplayRole:
+            return os.path.basename(path)
+        if role == Qt.DecorationRole:
+            return self.thumbnail(path)
+        if role == Qt.CheckStateRole:
+            return Qt.Checked if index.row() == self.checked_row else Qt.Unchecked
+        if role == self.StatusRole:
+            return self.mask_index.status(path)
+        if role == self.PathRole:
+            return path
+        return None
+
+    def thumbnail(self, path):
+        pixmap = self.pixmaps.get(path)
+        if pixmap is not None:
+            self.pixmaps.move_to_end(path)
+        elif path not in self.requested:
+            self.requested.add(path)
+            self.thumbnails.request(path)
+        return pixmap
+
+    def on_thumbnail_ready(self, path, image):
+        row = self.rows.get(path)
+        if row is None or image.isNull():
+            return
+        self.pixmaps[path] = QPixmap.fromImage(image)
+        if len(self.pixmaps) > self.max_thumbnails:
+            evicted, _ = self.pixmaps.popitem(last=False)
+            self.requested.discard(evicted)  # requested again from the disk cache once visible
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+    def addPaths(self, paths):
+        if not paths:
+            return
+        first = len(self.paths)
+        self.beginInsertRows(QModelIndex(), first, first + len(paths) - 1)
+        for path in paths:
+            self.rows[path] = len(self.paths)
+            self.name_rows.setdefault(MaskIndex.split(path), []).append(len(self.paths))
+            self.paths.append(path)
+        self.endInsertRows()
+
+    def toggleChecked(self, row):
+        previous = self.checked_row
+        self.checked_row = None if row == previous else row
+        for changed in (previous, row):
+            if changed is not None:
+                index = self.index(changed)
+                self.dataChanged.emit(index, index, [Qt.CheckStateRole])
+
+    def checkedPath(self):
+        if self.checked_row is None:
+            return None
+        return self.paths[self.checked_row]
+
+    def on_masks_changed(self, folder, names):
+        for name in names:
+            for row in self.name_rows.get((folder, name), []):
+                index = self.index(row)
+                self.dataChanged.emit(index, index, [self.StatusRole])
+
+
+class ImageItemDelegate(QStyledItemDelegate):
+    """Paints thumbnail, name, check box and mask status of one ImageListModel row"""
+    item_size = QSize(200, 250)
+    thumbnail_height = 170
+
+    def sizeHint(self, option, index):
+        return self.item_size
+
+    def paint(self, painter, option, index):
+        painter.save()
+        rect = option.rect
+        if option.state & QStyle.State_Selected:
+            painter.fillRect(rect, option.palette.highlight())
+
+        thumbnail_rect = QRect(rect.x() + 5, rect.y() + 5, rect.width() - 10, self.thumbnail_height)
+        pixmap = index.data(Qt.DecorationRole)
+        if pixmap is None:
+            painter.fillRect(thumbnail_rect, QColor(200, 200, 200))
+        else:
+            painter.drawPixmap(thumbnail_rect.topLeft(), pixmap,
+                               QRect(0, 0, thumbnail_rect.width(), thumbnail_rect.height()))
+
+        line_height = option.fontMetrics.height() + 4
+        y = thumbnail_rect.bottom() + 5
+        painter.setPen(option.palette.color(QtGui.QPalette.Text))
+        painter.drawText(QRect(rect.x() + 5, y, rect.width() - 10, line_height),
+                         Qt.AlignLeft | Qt.AlignVCenter, index.data(Qt.DisplayRole))
+
+        check = QStyleOptionButton()
+        check.rect = QRect(rect.x() + 5, y + line_height, rect.width() - 10, line_height)
+        check.text = "Check"
+        check.state = QStyle.State_Enabled | (QStyle.State_On if index.data(Qt.CheckStateRole) == Qt.Checked
+                                              else QStyle.State_Off)
+        style = option.widget.style() if option.widget else QApplication.style()
+        style.drawControl(QStyle.CE_CheckBox, check, painter, option.widget)
+
+        painter.drawText(QRect(rect.x() + 5, y + 2 * line_height, rect.width() - 10, line_height),
+                         Qt.AlignLeft | Qt.AlignVCenter, index.data(ImageListModel.StatusRole))
+        painter.restore()
 
 
 class Menu(QMainWindow):
@@ -13,8 +339,6 @@ class Menu(QMainWindow):
         super().__init__(parent)
         self.setWindowTitle('OptiLabel - menu')
         self.setGeometry(100, 100, 700, 500)
-        self.selected_paths = []
-        self.selected_checkbox = None
         self.light_mode = True  # Pôvodne je aplikácia v svetlom režime
 
         self.open_image_viewer_button = QPushButton("Open Image Viewer")
@@ -23,10 +347,16 @@ class Menu(QMainWindow):
         self.load_images_button = QPushButton("Load Images")
         self.load_images_button.clicked.connect(self.load_images)
 
-        self.list_widget = QListWidget()
-        self.list_widget.itemClicked.connect(self.item_clicked)
+        self.thumbnails = ThumbnailLoader(200, self)
+        self.mask_index = MaskIndex(self)
+        mask_writer().signals.failed.connect(self.on_mask_save_failed)
+        self.model = ImageListModel(self.thumbnails, self.mask_index, parent=self)
 
-        self.checkboxes = []
+        self.list_widget = QListView()
+        self.list_widget.setModel(self.model)
+        self.list_widget.setItemDelegate(ImageItemDelegate(self.list_widget))
+        self.list_widget.setUniformItemSizes(True)
+        self.list_widget.clicked.connect(self.item_clicked)
 
         self.light_dark_button = QPushButton(
             "Switch to Dark Mode")  # Tlačidlo na prepínanie medzi svetlým a tmavým režimom
@@ -60,98 +390,33 @@ class Menu(QMainWindow):
         if file_dialog.exec():
             selected_files = file_dialog.selectedFiles()
 
-            for path in selected_files:
+            new_paths = []
+            for path in dict.fromkeys(selected_files):
                 if self.check_duplicate_image(path):
-                    return
-
-                file_name = os.path.basename(path)
-                self.selected_paths.append(path)
-
-                image_label = QLabel()
-                name_label = QLabel(file_name)
-
-                pixmap = QPixmap(path)
-                desired_size = pixmap.scaledToWidth(200)
-                image_label.setPixmap(desired_size)
-
-                checkbox = QCheckBox("Check")
-                checkbox.stateChanged.connect(self.checkbox_state_changed)
-
-                # Check for existing masks and display status
-                mask_status_label = QLabel()
-                self.update_mask_status_label(mask_status_label, path)
-
-                item_widget = QWidget()
-                item_layout = QVBoxLayout(item_widget)
-                item_layout.addWidget(image_label)
-                item_layout.addWidget(name_label)
-                item_layout.addWidget(checkbox)
-                item_layout.addWidget(mask_status_label)  # Add the status label
-
-                item = QListWidgetItem()
-                item.setSizeHint(QSize(200, 250))  # Adjust size hint to accommodate status label
-                self.list_widget.addItem(item)
-                self.list_widget.setItemWidget(item, item_widget)
-
-                self.checkboxes.append(checkbox)
-                self.update_all_mask_statuses()
-
-    def update_mask_status_label(self, label, image_path):
-        # Check if the masks exist and update the label accordingly
-        base_path = os.path.dirname(image_path)
-        file_name = os.path.splitext(os.path.basename(image_path))[0]
-
-        vessel_mask_path = os.path.join(base_path, "VesselMasks", file_name + "_V.png")
-        macula_mask_path = os.path.join(base_path, "Macula", file_name + "_M.png")
-        optical_mask_path = os.path.join(base_path, "Optical", file_name + "_O.png")
-
-        status_text = []
-        if os.path.exists(vessel_mask_path):
-            status_text.append("V")
-        if os.path.exists(macula_mask_path):
-            status_text.append("M")
-        if os.path.exists(optical_mask_path):
-            status_text.append("O")
-
-        if status_text:
-            label.setText("Masks: " + ", ".join(status_text))
-        else:
-            label.setText("No masks")
+                    break
+                new_paths.append(path)
+            self.model.addPaths(new_paths)
 
     def check_duplicate_image(self, path):
-        if path in self.selected_paths:
+        if path in self.model.rows:
             QMessageBox.warning(self, "Upozornenie", "Obrázok " + os.path.basename(path) + " sa už v liste nachádza")
             return True
 
-    def checkbox_state_changed(self):
-        if self.selected_checkbox:
-            self.selected_checkbox.setChecked(False)
-
-        sender_checkbox = self.sender()
-
-        if sender_checkbox.isChecked():
-            self.selected_checkbox = sender_checkbox
-        else:
-            self.selected_checkbox = None
-
-    def item_clicked(self, item):
-        checkbox = self.list_widget.itemWidget(item).findChild(QCheckBox)
-
-        if checkbox.isChecked():
-            checkbox.setChecked(False)
-        else:
-            checkbox.setChecked(True)
+    def item_clicked(self, index):
+        self.model.toggleChecked(index.row())
 
     def openImageViewer(self):
-        if self.selected_checkbox:
-            index = self.checkboxes.index(self.selected_checkbox)
-            selected_path = self.selected_paths[index]
+        selected_path = self.model.checkedPath()
+        if selected_path is not None:
             image_viewer = ImageViewer(self, selected_path)
             image_viewer.windowClosed.connect(self.on_img_closed)
             image_viewer.show()
     def on_img_closed(self):
         self.update_all_mask_statuses()
 
+    def on_mask_save_failed(self, path, error):
+        QMessageBox.warning(self, "Upozornenie", "Masku " + os.path.basename(path) + " sa nepodarilo uložiť: " + error)
+
     def saveMaskAsPng(self):
         if self.imageLabel.currentMask == "Vessel network":
             vessel_folder = os.path.join(self.current_path, "VesselMasks")
@@ -178,27 +443,21 @@ class Menu(QMainWindow):
         self.update_all_mask_statuses()
 
     def update_all_mask_statuses(self):
-        # Iterate through all items in the list widget and update their mask status labels
-        for i in range(self.list_widget.count()):
-            item = self.list_widget.item(i)
-            item_widget = self.list_widget.itemWidget(item)
-            image_path = self.selected_paths[i]
-            mask_status_label = item_widget.findChildren(QLabel)[
-                -1]  # Assuming the status label is the last QLabel added
-            self.update_mask_status_label(mask_status_label, image_path)
+        # The watcher keeps the index current, this is a fallback for shares without change notifications
+        self.mask_index.refresh()
 
 
 
 
 class ImageViewer(QMainWindow):
     windowClosed = pyqtSignal()
-    def __init__(self, parent=None, file=None):
+    def __init__(self, parent=None, file=None, undo_budget_bytes=32 * 1024 * 1024):
         super().__init__(parent)
         self.file = file
         self.setWindowTitle('OptiLabel')
         self.setGeometry(100, 100, 700, 500)
 
-        self.imageWidget = ImageWidget(self.file)
+        self.imageWidget = ImageWidget(self.file, undo_budget_bytes)
 
         self.arrow_buttons_layout = ArrowButtonLayout()
 
@@ -207,8 +466,16 @@ class ImageViewer(QMainWindow):
         save_button.clicked.connect(self.imageWidget.saveMaskAsPng)
         load_button = QPushButton('Load Mask')
         load_button.clicked.connect(self.imageWidget.loadMask)
+        undo_button = QPushButton('Undo')
+        undo_button.clicked.connect(self.imageWidget.undo)
+        redo_button = QPushButton('Redo')
+        redo_button.clicked.connect(self.imageWidget.redo)
+        QShortcut(QKeySequence.Undo, self, self.imageWidget.undo)
+        QShortcut(QKeySequence.Redo, self, self.imageWidget.redo)
         self.top_buttons_layout.addWidget(save_button)
         self.top_buttons_layout.addWidget(load_button)
+        self.top_buttons_layout.addWidget(undo_button)
+        self.top_buttons_layout.addWidget(redo_button)
 
         self.mode_buttons_layout = QVBoxLayout()
         rect_button = QPushButton("Draw Rectangle")
@@ -217,17 +484,29 @@ class ImageViewer(QMainWindow):
         circ_button.clicked.connect(self.imageWidget.imageLabel.setCircle)
         rubber_button = QPushButton('Rubber')
         rubber_button.clicked.connect(self.imageWidget.imageLabel.setRubber)
+        wand_button = QPushButton('Vessel Assist')
+        wand_button.clicked.connect(self.imageWidget.imageLabel.setWand)
+        wand_button.setEnabled(PSTLabeler is not None)
         deleteMaskButton = QPushButton("Delete current mask")
         deleteMaskButton.clicked.connect(self.imageWidget.removeCurrentMask)
+        zoom_in_button = QPushButton("Zoom in")
+        zoom_in_button.clicked.connect(self.imageWidget.zoomIn)
+        zoom_out_button = QPushButton("Zoom out")
+        zoom_out_button.clicked.connect(self.imageWidget.zoomOut)
         Alfa = QLabel("Oppacity")
         Alfa.setAlignment(Qt.AlignCenter)
 
         self.mode_buttons_layout.addWidget(rect_button)
         self.mode_buttons_layout.addWidget(circ_button)
         self.mode_buttons_layout.addWidget(rubber_button)
+        self.mode_buttons_layout.addWidget(wand_button)
         self.mode_buttons_layout.addWidget(deleteMaskButton)
+        self.mode_buttons_layout.addWidget(zoom_in_button)
+        self.mode_buttons_layout.addWidget(zoom_out_button)
         self.mode_buttons_layout.addWidget(self.imageWidget.imageLabel.dropdown)
         self.mode_buttons_layout.addWidget(self.imageWidget.imageLabel.masks)
+        self.mode_buttons_layout.addWidget(self.imageWidget.showAllCheckbox)
+        self.mode_buttons_layout.addWidget(self.imageWidget.assistProgress)
 
         self.mode_buttons_layout.addStretch()
 
@@ -253,6 +532,7 @@ class ImageViewer(QMainWindow):
         self.closed.emit()
 
     def closeEvent(self, event):
+        self.imageWidget.cancelVesselAssist()
         self.windowClosed.emit()
         super(ImageViewer, self).closeEvent(event)
 
@@ -303,10 +583,308 @@ class ArrowButtonLayout(QVBoxLayout):
         self.down_button.setIcon(QIcon('icons/down_light.png' if self.light_mode else 'icons/down_dark.png'))
 
 
+def union_rect(a, b):
+    """Bounding rectangle of two (x0, y0, x1, y1) rectangles, either may be None"""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+@lru_cache(maxsize=32)
+def brush_disk(radius):
+    """Boolean disk stamp with given radius, cached per radius"""
+    yy, xx = np.ogrid[-radius:radius + 1, -radius:radius + 1]
+    disk = xx ** 2 + yy ** 2 <= radius ** 2
+    disk.setflags(write=False)
+    return disk
+
+
+class BrushEngine:
+    """Stamps precomputed disks into a mask and joins consecutive dabs of one stroke"""
+
+    def __init__(self):
+        self.lastPoint = None
+
+    def reset(self):
+        self.lastPoint = None
+
+    def stamp(self, mask, x, y, radius, bit, erase=False):
+        h, w = mask.shape[:2]
+        x0, y0 = max(x - radius, 0), max(y - radius, 0)
+        x1, y1 = min(x + radius + 1, w), min(y + radius + 1, h)
+        if x0 >= x1 or y0 >= y1:
+            return None
+
+        disk = brush_disk(radius)[y0 - y + radius:y1 - y + radius, x0 - x + radius:x1 - x + radius]
+        region = mask[y0:y1, x0:x1]
+        if erase:
+            region[disk] &= 0xFF ^ bit
+        else:
+            region[disk] |= bit
+        return x0, y0, x1, y1
+
+    def stroke(self, mask, x, y, radius, bit, erase=False):
+        """Stamps the segment from the previous dab to (x, y), returns the dirty rectangle (x0, y0, x1, y1)"""
+        if self.lastPoint is None:
+            points = [(x, y)]
+        else:
+            px, py = self.lastPoint
+            # dabs half a radius apart keep the stroke continuous for fast mouse moves
+            steps = max(int(np.hypot(x - px, y - py) / max(radius / 2, 1)), 1)
+            t = np.linspace(0, 1, steps + 1)[1:]
+            points = zip(np.rint(px + t * (x - px)).astype(int), np.rint(py + t * (y - py)).astype(int))
+        self.lastPoint = (x, y)
+
+        dirty = None
+        for px, py in points:
+            dirty = union_rect(dirty, self.stamp(mask, int(px), int(py), radius, bit, erase))
+        return dirty
+
+
+class LabelStore:
+    """All label classes of one image kept in a single uint8 plane, class i is stored in bit i.
+    Classes may overlap (a vessel can cross the optical disk) and up to 8 classes fit into the plane.
+    """
+
+    def __init__(self, shape, classes=LABEL_CLASSES):
+        assert len(classes) <= 8, "LabelStore holds at most 8 classes"
+        self.plane = np.zeros(shape, dtype=np.uint8)
+        self.classes = classes
+        self.bits = {name: 1 << i for i, (name, _, _, _) in enumerate(classes)}
+        self.luts = {}
+
+    @property
+    def shape(self):
+        return self.plane.shape
+
+    def bit(self, name):
+        return self.bits[name]
+
+    def region(self, name, x0=0, y0=0, x1=None, y1=None):
+        """Boolean mask of class name inside rectangle (x0, y0, x1, y1)"""
+        return (self.plane[y0:y1, x0:x1] & self.bits[name]) != 0
+
+    def mask(self, name):
+        """Class name as a standalone 0/255 mask, the format masks are saved in"""
+        return self.region(name).view(np.uint8) * np.uint8(255)
+
+    def fillRect(self, name, x0, y0, x1, y1, erase=False):
+        if erase:
+            self.plane[y0:y1, x0:x1] &= 0xFF ^ self.bits[name]
+        else:
+            self.plane[y0:y1, x0:x1] |= self.bits[name]
+
+    def setMask(self, name, mask):
+        bit = self.bits[name]
+        np.bitwise_and(self.plane, 0xFF ^ bit, out=self.plane)
+        self.plane[mask > 0] |= bit
+
+    def clear(self, name):
+        np.bitwise_and(self.plane, 0xFF ^ self.bits[name], out=self.plane)
+
+    def colorLut(self, names):
+        """256 x 3 lookup table mapping plane values to the summed colours of visible classes"""
+        names = tuple(names)
+        lut = self.luts.get(names)
+        if lut is None:
+            values = np.arange(256)
+            lut = np.zeros((256, 3), dtype=np.int32)
+            for name, _, _, color in self.classes:
+                if name in names:
+                    lut[(values & self.bits[name]) != 0] += color
+            lut = np.clip(lut, 0, 255).astype(np.uint8)
+            self.luts[names] = lut
+        return lut
+
+
+class ImagePyramid:
+    """Multi-resolution view of an image, level n is downsampled by 2 ** n.
+    Levels above 0 are split into tiles which are resized on first use and
+    kept in a bounded LRU cache, so only tiles around the viewport are ever built.
+    """
+
+    def __init__(self, image, levels=4, tileSize=256, maxTiles=256):
+        self.image = image
+        self.levels = levels
+        self.tileSize = tileSize
+        self.maxTiles = maxTiles
+        self.tiles = OrderedDict()
+
+    def factor(self, level):
+        return 2 ** level
+
+    def shape(self, level):
+        f = self.factor(level)
+        return -(-self.image.shape[0] // f), -(-self.image.shape[1] // f)
+
+    def tile(self, level, ty, tx):
+        key = (level, ty, tx)
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+            return tile
+
+        f, t = self.factor(level), self.tileSize
+        source = self.image[ty * t * f:(ty + 1) * t * f, tx * t * f:(tx + 1) * t * f]
+        size = (-(-source.shape[1] // f), -(-source.shape[0] // f))
+        tile = cv2.resize(source, size, interpolation=cv2.INTER_AREA)
+
+        self.tiles[key] = tile
+        if len(self.tiles) > self.maxTiles:
+            self.tiles.popitem(last=False)
+        return tile
+
+    def region(self, level, x0, y0, x1, y1):
+        """Returns rectangle (x0, y0, x1, y1) given in level coordinates"""
+        if level == 0:
+            return self.image[y0:y1, x0:x1]
+
+        t = self.tileSize
+        region = np.empty((y1 - y0, x1 - x0) + self.image.shape[2:], dtype=self.image.dtype)
+        for ty in range(y0 // t, (y1 - 1) // t + 1):
+            for tx in range(x0 // t, (x1 - 1) // t + 1):
+                tile = self.tile(level, ty, tx)
+                ax0, ax1 = max(x0, tx * t), min(x1, tx * t + tile.shape[1])
+                ay0, ay1 = max(y0, ty * t), min(y1, ty * t + tile.shape[0])
+                region[ay0 - y0:ay1 - y0, ax0 - x0:ax1 - x0] = tile[ay0 - ty * t:ay1 - ty * t, ax0 - tx * t:ax1 - tx * t]
+        return region
+
+    def maskRegion(self, mask, level, x0, y0, x1, y1):
+        """Nearest-neighbour view of a full resolution mask in level coordinates, no copy is made"""
+        f = self.factor(level)
+        return mask[y0 * f:y1 * f:f, x0 * f:x1 * f:f]
+
+
+class UndoHistory:
+    """Undo/redo stack of label plane edits.
+    An entry keeps only the XOR delta of the edited bounding box, zlib compressed,
+    so undo and redo apply the very same delta. The last committed state is kept
+    in a shadow plane; when the entries exceed budget_bytes the oldest are dropped.
+    budget_bytes bounds the entries only, the shadow plane is a fixed overhead of
+    plane.nbytes on top of it (memory_bytes reports both).
+    """
+
+    def __init__(self, plane, budget_bytes=32 * 1024 * 1024):
+        self.plane = plane
+        self.shadow = plane.copy()
+        self.budget_bytes = budget_bytes
+        self.used_bytes = 0
+        self.undo_stack = deque()
+        self.redo_stack = []
+
+    @property
+    def memory_bytes(self):
+        """memory held by the history: the shadow plane and the compressed entries"""
+        return self.shadow.nbytes + self.used_bytes
+
+    def commit(self, rect=None):
+        """Records changes made inside rect (x0, y0, x1, y1) since the last commit, None means whole plane"""
+        h, w = self.plane.shape
+        x0, y0, x1, y1 = rect if rect is not None else (0, 0, w, h)
+        x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, w), min(y1, h)
+        if x0 >= x1 or y0 >= y1:
+            return
+        delta = self.plane[y0:y1, x0:x1] ^ self.shadow[y0:y1, x0:x1]
+        if not delta.any():
+            return
+        self.shadow[y0:y1, x0:x1] = self.plane[y0:y1, x0:x1]
+
+        entry = ((x0, y0, x1, y1), zlib.compress(delta.tobytes(), 1))
+        self.undo_stack.append(entry)
+        self.used_bytes += len(entry[1]) - sum(len(data) for _, data in self.redo_stack)
+        self.redo_stack.clear()
+        while self.used_bytes > self.budget_bytes and len(self.undo_stack) > 1:
+            self.used_bytes -= len(self.undo_stack.popleft()[1])
+
+    def apply(self, entry):
+        (x0, y0, x1, y1), data = entry
+        delta = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(y1 - y0, x1 - x0)
+        self.plane[y0:y1, x0:x1] ^= delta
+        self.shadow[y0:y1, x0:x1] ^= delta
+        return x0, y0, x1, y1
+
+    def undo(self):
+        """Reverts the last edit, returns its rectangle or None if there is nothing to undo"""
+        self.commit()  # changes that were not committed yet become their own entry
+        if not self.undo_stack:
+            return None
+        entry = self.undo_stack.pop()
+        self.redo_stack.append(entry)
+        return self.apply(entry)
+
+    def redo(self):
+        if not self.redo_stack:
+            return None
+        entry = self.redo_stack.pop()
+        self.undo_stack.append(entry)
+        return self.apply(entry)
+
+
+class OverlayCompositor:
+    """Keeps the blended viewport cached and recomposites only its dirty rectangles.
+    The viewport is kept in a persistent BGRA buffer laid out as QImage.Format_RGB32.
+    """
+
+    def __init__(self):
+        self.buffer = None
+        self.pyramid = None
+        self.level = 0
+        self.plane = None
+        self.lut = None
+        self.alfa = 0.0
+        self.originX = 0
+        self.originY = 0
+
+    def render(self, pyramid, level, labels, names, alfa, x, y, width, height):
+        """Blends visible label classes over the whole viewport starting at (x, y) of pyramid level
+        and returns it. All classes are coloured in one pass through a lookup table.
+        """
+        levelHeight, levelWidth = pyramid.shape(level)
+        height = min(height, levelHeight - y)
+        width = min(width, levelWidth - x)
+        if self.buffer is None or self.buffer.shape[:2] != (height, width):
+            self.buffer = np.full((height, width, 4), 255, dtype=np.uint8)
+
+        self.pyramid, self.level = pyramid, level
+        self.plane, self.lut, self.alfa = labels.plane, labels.colorLut(names), alfa
+        self.originX, self.originY = x, y
+        self.blend(0, 0, width, height)
+        return self.buffer
+
+    def refresh(self, rect):
+        """Recomposites full resolution rectangle (x0, y0, x1, y1) intersected with the viewport.
+        Returns the changed viewport rectangle or None if nothing visible changed.
+        """
+        if self.buffer is None or rect is None:
+            return None
+        f = self.pyramid.factor(self.level)
+        height, width = self.buffer.shape[:2]
+        x0, x1 = max(rect[0] // f - self.originX, 0), min(-(-rect[2] // f) - self.originX, width)
+        y0, y1 = max(rect[1] // f - self.originY, 0), min(-(-rect[3] // f) - self.originY, height)
+        if x0 >= x1 or y0 >= y1:
+            return None
+
+        self.blend(x0, y0, x1, y1)
+        return x0, y0, x1, y1
+
+    def blend(self, x0, y0, x1, y1):
+        ix, iy = self.originX, self.originY
+        source = self.pyramid.region(self.level, ix + x0, iy + y0, ix + x1, iy + y1)
+        plane = self.pyramid.maskRegion(self.plane, self.level, ix + x0, iy + y0, ix + x1, iy + y1)
+        coloredMask = self.lut[plane]
+        self.buffer[y0:y1, x0:x1, :3] = cv2.addWeighted(source, 1, coloredMask, self.alfa, 0)
+
+
 class PaintableLabel(QLabel):
     finishedDrawingRect = pyqtSignal(QPoint, QPoint)
     finishedDrawingCirc = pyqtSignal(QPoint, int)
     finishedRubb = pyqtSignal(QPoint, int)
+    strokeStarted = pyqtSignal()
+    strokeFinished = pyqtSignal()
+    zoomRequested = pyqtSignal(int, QPoint)
+    wandClicked = pyqtSignal(QPoint)
 
     updateScreen = pyqtSignal()
 
@@ -318,10 +896,12 @@ class PaintableLabel(QLabel):
         self.setMouseTracking(True)
 
         self.pos = None
+        self.frame = None
 
         self.rectangle = True
         self.rubber = False
         self.circle = False
+        self.wand = False
 
         self.radius = 1
 
@@ -331,7 +911,7 @@ class PaintableLabel(QLabel):
         self.dropdown.currentIndexChanged.connect(self.onIndexChanged)
 
         self.masks = QComboBox()
-        values = ["Vessel network", "Macula", "Optical disk"]
+        values = [name for name, _, _, _ in LABEL_CLASSES]
         self.masks.addItems([str(value) for value in values])
         self.masks.currentIndexChanged.connect(self.onIndexChangedMask)
 
@@ -341,9 +921,15 @@ class PaintableLabel(QLabel):
         self.currentMask = self.masks.currentText()
         self.updateScreen.emit()
 
+    def setFrame(self, frame):
+        self.frame = frame
+        self.update()
+
     def paintEvent(self, event):
         super().paintEvent(event)
         painter = QPainter(self)
+        if self.frame is not None:
+            painter.drawImage(event.rect(), self.frame, event.rect())
         if self.drawing and self.rectangle:
             painter.setPen(QColor(255, 0, 0, 128))
             painter.drawRect(QRect(self.begin, self.end))
@@ -355,10 +941,17 @@ class PaintableLabel(QLabel):
                                 self.radius * 2)
 
     def mousePressEvent(self, event):
-        if event.button() == Qt.LeftButton:
+        if event.button() == Qt.LeftButton and self.wand:
+            self.wandClicked.emit(event.pos())
+        elif event.button() == Qt.LeftButton:
             self.drawing = True
             self.begin = event.pos()
             self.end = event.pos()
+            self.strokeStarted.emit()
+            if self.circle:
+                self.finishedDrawingCirc.emit(self.end, self.radius)
+            if self.rubber:
+                self.finishedRubb.emit(self.end, self.radius)
             self.update()
 
     def mouseMoveEvent(self, event):
@@ -384,6 +977,14 @@ class PaintableLabel(QLabel):
             self.update()
             if self.rectangle:
                 self.finishedDrawingRect.emit(self.begin, self.end)
+            self.strokeFinished.emit()
+
+    def wheelEvent(self, event):
+        if event.modifiers() & Qt.ControlModifier:
+            self.zoomRequested.emit(1 if event.angleDelta().y() > 0 else -1, event.pos())
+            event.accept()
+        else:
+            super().wheelEvent(event)
 
     def onIndexChanged(self):
         self.radius = int(self.dropdown.currentText())
@@ -392,26 +993,228 @@ class PaintableLabel(QLabel):
         self.rubber = True
         self.rectangle = False
         self.circle = False
+        self.wand = False
 
     def setCircle(self):
         self.rubber = False
         self.rectangle = False
         self.circle = True
+        self.wand = False
 
     def setRectangle(self):
         self.rubber = False
         self.rectangle = True
         self.circle = False
+        self.wand = False
+
+    def setWand(self):
+        self.rubber = False
+        self.rectangle = False
+        self.circle = False
+        self.wand = True
+
+
+class MaskWriterSignals(QObject):
+    failed = pyqtSignal(str, str)  # mask path, error
+
+
+class MaskWriter:
+    """Background writer of mask PNGs.
+    save() only snapshots the mask, encoding and writing happens in a worker thread.
+    Pending saves of the same path are coalesced so only the newest snapshot is written.
+    Masks are written to a temporary file which is then renamed over the target,
+    so an interrupted save never leaves a half written mask on disk.
+    Failed saves are reported by signals.failed, the worker keeps running.
+    """
+
+    def __init__(self, compress_level=1):
+        self.compress_level = compress_level
+        self.pending = OrderedDict()
+        self.writing = False
+        self.condition = threading.Condition()
+        self.thread = None
+        self.signals = MaskWriterSignals()
+
+    def save(self, path, mask, copy=True):
+        """Queues mask for writing, copy=False hands over a mask the caller will not modify anymore"""
+        snapshot = mask.copy() if copy else mask
+        with self.condition:
+            self.pending[path] = snapshot
+            self.pending.move_to_end(path)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="MaskWriter", daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending)
+                path, mask = self.pending.popitem(last=False)
+                self.writing = True
+            try:
+                self.write(path, mask)
+            except Exception as e:
+                # any error (e.g. a bad path or extension) must not kill the worker, flush() would wait forever
+                print("Failed to save mask " + path + ": " + str(e))
+                self.signals.failed.emit(path, str(e))
+            finally:
+                with self.condition:
+                    self.writing = False
+                    self.condition.notify_all()
+
+    def write(self, path, mask):
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=folder)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                Image.fromarray(mask).save(f, format="PNG", compress_level=self.compress_level)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def flush(self, timeout=None):
+        """Blocks until all pending masks are written"""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.writing, timeout)
+
+
+@lru_cache(maxsize=None)
+def mask_writer():
+    """Shared MaskWriter, its thread is started on first use instead of on import"""
+    return MaskWriter()
+
+
+class CancelToken:
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class VesselAssistSignals(QObject):
+    progress = pyqtSignal(object, int)  # token, percent
+    finished = pyqtSignal(object, object)  # token, PSTResult or None if the pipeline failed
+
+
+class VesselAssistTask(QRunnable):
+    """Runs the PST pipeline of one image, a cancelled task stops before its next step"""
+
+    def __init__(self, assist, image, token):
+        super().__init__()
+        self.assist = assist
+        self.image = image
+        self.token = token
+        self.signals = VesselAssistSignals()
+
+    def run(self):
+        try:
+            key = self.assist.cache.key(self.image, dict(self.assist.params, **self.assist.postprocess),
+                                        self.assist.labeler().backend)
+            mask = self.assist.cache.get(key, "assist")
+        except Exception as e:
+            print("Vessel assist failed: " + str(e))
+            key, mask = None, None
+        if mask is not None:
+            # Image was processed before, the post-processed mask is loaded from the cache
+            self.signals.progress.emit(self.token, 100)
+            self.signals.finished.emit(self.token, PSTResult(mask))
+            return
+
+        post = self.assist.postprocess
+        steps = (lambda result: self.assist.labeler().apply(self.image),
+                 lambda result: result.denoise(thresh_px=post["thresh_px"]),
+                 lambda result: result.mask_reconstruction(post["ksize_closing"], post["ksize_median"]),
+                 lambda result: result.denoise(thresh_px=post["thresh_px_final"]))
+        result = None
+        try:
+            for i, step in enumerate(steps):
+                if self.token.cancelled:
+                    return
+                result = step(result)
+                self.signals.progress.emit(self.token, 100 * (i + 1) // len(steps))
+            if key is not None:
+                self.assist.cache.put(key, result.edges, "assist")
+        except Exception as e:
+            print("Vessel assist failed: " + str(e))
+            result = None
+        if not self.token.cancelled:
+            self.signals.finished.emit(self.token, result)
+
+
+class VesselAssist:
+    """Precomputes PST vessel candidates of opened images in a single background thread,
+    so the labeler is never used by two threads at once.
+    PST outputs and assist masks are cached on disk by image content, reopened images load instantly.
+    """
+    # PST parameters as in semi_auto_labeling_lib/examples/pst_labeling.py
+    params = dict(phase_strength=20, warp_strength=400, sigma_LPF=0.1, thresh_min=0.05, thresh_max=0.75)
+    # Post-processing of the PST mask, part of the cache key of the assist masks
+    postprocess = dict(thresh_px=25, ksize_closing=15, ksize_median=7, thresh_px_final=100)
+
+    def __init__(self):
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(1)
+        self._labeler = None
+        self.cache = PSTResultCache(os.path.join(
+            QStandardPaths.writableLocation(QStandardPaths.GenericCacheLocation), "OptiLabel", "pst_results"))
+
+    def labeler(self):
+        # Built in the worker thread on first use, torch is imported only if it is installed
+        if self._labeler is None:
+            try:
+                labeler = PSTLabeler(result_cache=self.cache)
+            except ImportError:
+                labeler = PSTLabeler(backend="numpy", result_cache=self.cache)
+            labeler.set_params(self.params)
+            self._labeler = labeler
+        return self._labeler
+
+    def start(self, image, onProgress, onFinished):
+        token = CancelToken()
+        task = VesselAssistTask(self, image, token)
+        task.signals.progress.connect(onProgress)
+        task.signals.finished.connect(onFinished)
+        self.pool.start(task)
+        return token
+
+
+@lru_cache(maxsize=None)
+def vessel_assist():
+    """Shared VesselAssist created on first use, None if auto_labeling is missing"""
+    return VesselAssist() if PSTLabeler is not None else None
 
 
 class ImageWidget(QWidget):
+    """undo_budget_bytes bounds the memory of the undo entries of the opened image, see UndoHistory"""
 
-    def __init__(self, fileName=None):
+    def __init__(self, fileName=None, undo_budget_bytes=32 * 1024 * 1024):
         super().__init__()
         self.imageLabel = PaintableLabel(self)
         self.imageLabel.finishedDrawingRect.connect(self.drawMaskRect)
         self.imageLabel.finishedDrawingCirc.connect(self.drawMaskCirc)
         self.imageLabel.finishedRubb.connect(self.removeMaskRubb)
+        self.imageLabel.zoomRequested.connect(self.zoom)
+        self.imageLabel.wandClicked.connect(self.vesselAssistClick)
+
+        self.brush = BrushEngine()
+        self.imageLabel.strokeStarted.connect(self.brush.reset)
+        self.imageLabel.strokeFinished.connect(self.commitStroke)
+        self.strokeRect = None
+        self.history = None
+        self.undo_budget_bytes = undo_budget_bytes
+        self.compositor = OverlayCompositor()
+        self.frameBuffer = None
+        self.pyramid = None
+        self.level = 0
 
         self.fileName = fileName
 
@@ -421,7 +1224,7 @@ class ImageWidget(QWidget):
         self.originalImage = None
         self.image_to_show = None
 
-        self.maskImage = None
+        self.labels = None
 
         self.left_edge = 0
         self.right_edge = self.label_width
@@ -429,10 +1232,6 @@ class ImageWidget(QWidget):
         self.bottom_edge = 0
         self.shift = 100
 
-        self.vsselMask = None
-        self.diskMask = None
-        self.maculaMask = None
-
         self.current_path = None
         self.file_name = None  # "C:/Users/novypouzivatel/Desktop/skola/TimProjekt/data"
 
@@ -465,6 +1264,17 @@ class ImageWidget(QWidget):
         self.sliderAlfa.setValue(50)
         self.sliderAlfa.valueChanged.connect(self.updateDisplay)
 
+        self.showAllCheckbox = QCheckBox("Show all masks")
+        self.showAllCheckbox.stateChanged.connect(self.updateDisplay)
+
+        self.pstResult = None
+        self.pstEdges = None
+        self.assistToken = None
+        self.assistProgress = QProgressBar()
+        self.assistProgress.setRange(0, 100)
+        self.assistProgress.setFormat("Vessel assist %p%")
+        self.assistProgress.setVisible(False)
+
         self.setLayout(alloverLayout)
 
         self.openImage()
@@ -481,60 +1291,131 @@ class ImageWidget(QWidget):
 
             self.file_name = file_name
 
-            self.maskImage = np.zeros(self.originalImage.shape[:2], dtype=np.uint8)
-            self.vsselMask = np.zeros(self.originalImage.shape[:2], dtype=np.uint8)
-            self.diskMask = np.zeros(self.originalImage.shape[:2], dtype=np.uint8)
-            self.maculaMask = np.zeros(self.originalImage.shape[:2], dtype=np.uint8)
-            # self.image_to_show_mask = self.maskImage[:self.label_width,:self.label_height]
+            self.labels = LabelStore(self.originalImage.shape[:2])
+            self.history = UndoHistory(self.labels.plane, self.undo_budget_bytes)
             h, w, ch = self.originalImage.shape
             self.label_height = h
             self.label_width = w
-            self.sliderHor.setMinimum(0)
-            self.sliderHor.setMaximum(h - self.fix_height)
-            self.sliderHor.setValue(0)
-            self.sliderVer.setMinimum(0)
-            self.sliderVer.setMaximum(w - self.fix_width)
-            self.sliderVer.setValue(0)
+            self.pyramid = ImagePyramid(self.originalImage)
+            self.level = 0
+            self.zoom_level = 1.0
+            self.updateSliders(0, 0)
             self.imageLabel.setFixedSize(self.fix_width, self.fix_height)
             self.updateDisplay()
+            self.startVesselAssist()
+
+    def startVesselAssist(self):
+        self.cancelVesselAssist()
+        self.pstResult = None
+        self.pstEdges = None
+        if vessel_assist() is not None and self.originalImage is not None:
+            self.assistProgress.setValue(0)
+            self.assistProgress.setVisible(True)
+            self.assistToken = vessel_assist().start(self.originalImage, self.onAssistProgress, self.onAssistFinished)
+
+    def cancelVesselAssist(self):
+        if self.assistToken is not None:
+            self.assistToken.cancel()
+            self.assistToken = None
+        self.assistProgress.setVisible(False)
+
+    def onAssistProgress(self, token, percent):
+        if token is self.assistToken:
+            self.assistProgress.setValue(percent)
+
+    def onAssistFinished(self, token, result):
+        # Results of cancelled runs (another image was opened meanwhile) are dropped
+        if token is not self.assistToken:
+            return
+        self.assistToken = None
+        self.assistProgress.setVisible(False)
+        if result is not None:
+            self.pstResult = result
+            self.pstEdges = result.edges
+
+    def vesselAssistClick(self, point):
+        # Merges the PST component under the click into the vessel mask
+        if self.pstResult is None or self.labels is None:
+            return
+        x, y = self.toImage(point)
+        h, w = self.labels.shape
+        if not (0 <= x < w and 0 <= y < h) or not self.pstEdges[y, x]:
+            return
+        crop, (x0, y0, cw, ch) = self.pstResult.extract_crop_at(x, y)
+        region = self.labels.plane[y0:y0 + ch, x0:x0 + cw]
+        np.bitwise_or(region, crop * np.uint8(self.labels.bit("Vessel network")), out=region)
+        rect = (x0, y0, x0 + cw, y0 + ch)
+        self.history.commit(rect)
+        self.updateDirty(rect)
+
+    def updateSliders(self, x, y):
+        # Slider ranges and values are in coordinates of the current pyramid level
+        h, w = self.pyramid.shape(self.level)
+        for slider in (self.sliderHor, self.sliderVer):
+            slider.blockSignals(True)
+        self.sliderHor.setMinimum(0)
+        self.sliderHor.setMaximum(max(h - self.fix_height, 0))
+        self.sliderHor.setValue(y)
+        self.sliderVer.setMinimum(0)
+        self.sliderVer.setMaximum(max(w - self.fix_width, 0))
+        self.sliderVer.setValue(x)
+        for slider in (self.sliderHor, self.sliderVer):
+            slider.blockSignals(False)
+
+    def zoom(self, direction, anchor=None):
+        if self.pyramid is None:
+            return
+        level = min(max(self.level - direction, 0), self.pyramid.levels - 1)
+        if level == self.level:
+            return
+        if anchor is None:
+            anchor = QPoint(self.fix_width // 2, self.fix_height // 2)
+
+        # Keep the image point under the anchor in place
+        x, y = self.toImage(anchor)
+        self.level = level
+        self.zoom_level = 1 / self.pyramid.factor(level)
+        f = self.pyramid.factor(level)
+        self.updateSliders(max(x // f - anchor.x(), 0), max(y // f - anchor.y(), 0))
+        self.updateDisplay()
 
-    def drawMaskCirc(self, center, radius):
-        if self.originalImage is not None:
-            x_center, y_center = center.x() + self.startX, center.y() + self.startY
+    def zoomIn(self):
+        self.zoom(1)
 
-            for y in range(int(y_center - radius), int(y_center + radius) + 1):
-                for x in range(int(x_center - radius), int(x_center + radius) + 1):
-                    if (x - x_center) ** 2 + (y - y_center) ** 2 <= radius ** 2:
+    def zoomOut(self):
+        self.zoom(-1)
 
-                        if self.imageLabel.currentMask == "Vessel network":
-                            self.vsselMask[y, x] = 255
-                        elif self.imageLabel.currentMask == "Macula":
-                            self.maculaMask[y, x] = 255
-                        elif self.imageLabel.currentMask == "Optical disk":
-                            self.diskMask[y, x] = 255
+    def toImage(self, point):
+        f = self.pyramid.factor(self.level)
+        return (point.x() + self.startX) * f, (point.y() + self.startY) * f
 
-            self.updateDisplay()
+    def visibleClasses(self):
+        if self.showAllCheckbox.isChecked():
+            return [name for name, _, _, _ in LABEL_CLASSES]
+        return [self.imageLabel.currentMask]
 
-    def removeMaskRubb(self, center, radius):
+    def drawMaskCirc(self, center, radius):
         if self.originalImage is not None:
-            x_center, y_center = center.x() + self.startX, center.y() + self.startY
-
-            for y in range(int(y_center - radius), int(y_center + radius) + 1):
-                for x in range(int(x_center - radius), int(x_center + radius) + 1):
-                    if (x - x_center) ** 2 + (y - y_center) ** 2 <= radius ** 2:
-                        if self.imageLabel.currentMask == "Vessel network":
-                            self.vsselMask[y, x] = 0
-                        elif self.imageLabel.currentMask == "Macula":
-                            self.maculaMask[y, x] = 0
-                        elif self.imageLabel.currentMask == "Optical disk":
-                            self.diskMask[y, x] = 0
+            x_center, y_center = self.toImage(center)
+            radius *= self.pyramid.factor(self.level)
+            dirty = self.brush.stroke(self.labels.plane, x_center, y_center, radius,
+                                      self.labels.bit(self.imageLabel.currentMask))
+            self.strokeRect = union_rect(self.strokeRect, dirty)
+            self.updateDirty(dirty)
 
-            self.updateDisplay()
+    def removeMaskRubb(self, center, radius):
+        if self.originalImage is not None:
+            x_center, y_center = self.toImage(center)
+            radius *= self.pyramid.factor(self.level)
+            dirty = self.brush.stroke(self.labels.plane, x_center, y_center, radius,
+                                      self.labels.bit(self.imageLabel.currentMask), erase=True)
+            self.strokeRect = union_rect(self.strokeRect, dirty)
+            self.updateDirty(dirty)
 
     def drawMaskRect(self, begin, end):
         if self.originalImage is not None:
-            x_start, y_start = begin.x() + self.startX, begin.y() + self.startY
-            x_end, y_end = end.x() + self.startX, end.y() + self.startY
+            x_start, y_start = self.toImage(begin)
+            x_end, y_end = self.toImage(end)
             x1, x2 = min(x_start, x_end), max(x_start, x_end)
             y1, y2 = min(y_start, y_end), max(y_start, y_end)
 
@@ -543,48 +1424,54 @@ class ImageWidget(QWidget):
 
             x1 += self.left_edge
             x2 += self.left_edge
-            # self.maskImage[y1+self.top_edge:y2+self.top_edge, x1+self.left_edge:x2+self.top_edge] = 255
-            self.maskImage[y1:y2, x1:x2] = 255
-            if self.imageLabel.currentMask == "Vessel network":
-                self.vsselMask[y1:y2, x1:x2] = 255
-            elif self.imageLabel.currentMask == "Macula":
-                self.maculaMask[y1:y2, x1:x2] = 255
-            elif self.imageLabel.currentMask == "Optical disk":
-                self.diskMask[y1:y2, x1:x2] = 255
+            self.labels.fillRect(self.imageLabel.currentMask, x1, y1, x2, y2)
+            self.history.commit((x1, y1, x2, y2))
             # self.originalImage[self.bottom_edge:self.top_edge,self.left_edge:self.right_edge,:] = self.image_to_show
             # self.maskImage[self.bottom_edge:self.top_edge,self.left_edge:self.right_edge] = self.image_to_show_mask#[self.top_edge:self.bottom_edge,self.left_edge:self.right_edge]
 
-            self.updateDisplay()
-
-    def updateDisplay(self):
-        if self.originalImage is not None:
-            self.image_to_show = self.originalImage
-            if self.maskImage is not None:
-                coloredMask = np.zeros_like(self.originalImage, dtype=np.uint8)
-                if self.imageLabel.currentMask == "Vessel network":
-                    coloredMask[self.vsselMask > 0] = [255, 255, 0]
-                elif self.imageLabel.currentMask == "Macula":
-                    coloredMask[self.maculaMask > 0] = [128, 0, 128]
-                elif self.imageLabel.currentMask == "Optical disk":
-                    coloredMask[self.diskMask > 0] = [255, 0, 0]
-
-                alfa = self.sliderAlfa.value() / 100
-                self.image_to_show = cv2.addWeighted(self.originalImage, 1, coloredMask, alfa, 0)
+            self.updateDirty((x1, y1, x2, y2))
 
-            self.show_image()
+    def commitStroke(self):
+        if self.history is not None and self.strokeRect is not None:
+            self.history.commit(self.strokeRect)
+        self.strokeRect = None
 
-    def show_image(self):
+    def undo(self):
+        if self.history is not None:
+            self.updateDirty(self.history.undo())
 
-        self.startY = self.sliderHor.value()
-        self.startX = self.sliderVer.value()
+    def redo(self):
+        if self.history is not None:
+            self.updateDirty(self.history.redo())
 
-        height, width, _ = self.image_to_show.shape
+    def updateDisplay(self):
+        if self.originalImage is not None:
+            self.startY = self.sliderHor.value()
+            self.startX = self.sliderVer.value()
 
-        zoomed_image = self.image_to_show[self.startY:self.startY + self.fix_height,
-                       self.startX:self.startX + self.fix_width]
+            alfa = self.sliderAlfa.value() / 100
+            self.image_to_show = self.compositor.render(self.pyramid, self.level, self.labels,
+                                                        self.visibleClasses(), alfa,
+                                                        self.startX, self.startY, self.fix_width, self.fix_height)
+            self.show_image()
 
-        piximage = self.convert_cv_qt(zoomed_image)
-        self.imageLabel.setPixmap(piximage)
+    def updateDirty(self, rect):
+        # Only the edited rectangle of the visible viewport is blended again
+        if self.originalImage is not None:
+            changed = self.compositor.refresh(rect)
+            if changed is not None:
+                self.show_image(changed)
+
+    def show_image(self, rect=None):
+        # The QImage wraps the compositor buffer, it is rebuilt only when the buffer is reallocated
+        if self.frameBuffer is not self.image_to_show:
+            self.frameBuffer = self.image_to_show
+            self.imageLabel.setFrame(self.convert_cv_qt(self.image_to_show))
+        elif rect is None:
+            self.imageLabel.update()
+        else:
+            x0, y0, x1, y1 = rect
+            self.imageLabel.update(QRect(x0, y0, x1 - x0, y1 - y0))
 
     def right_button_action(self):
         if self.originalImage is not None:
@@ -611,54 +1498,29 @@ class ImageWidget(QWidget):
                 self.updateDisplay()
 
     def convert_cv_qt(self, cv_img):
-        """Convert from an opencv image to QPixmap"""
-        rgb_image = cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB)
-        h, w, ch = rgb_image.shape
-        bytes_per_line = ch * w
-        convert_to_Qt_format = QImage(rgb_image.data, w, h, bytes_per_line, QtGui.QImage.Format_RGB888)
-        p = convert_to_Qt_format.scaled(self.fix_width, self.fix_height, Qt.KeepAspectRatio)
-        return QPixmap.fromImage(p)
+        """Wrap a contiguous BGRA opencv image into QImage without copying.
+        The returned QImage shares memory with cv_img, which has to outlive it.
+        """
+        h, w, ch = cv_img.shape
+        return QImage(cv_img.data, w, h, cv_img.strides[0], QtGui.QImage.Format_RGB32)
 
     def saveMaskAsPng(self):
-        if self.imageLabel.currentMask == "Vessel network":
-            vessel_folder = os.path.join(self.current_path, "VesselMasks")
-            print(vessel_folder)
-            if not os.path.exists(vessel_folder):
-                os.makedirs(vessel_folder)
-            image_path = os.path.join(vessel_folder, self.file_name + "_" + "V.png")
-
-            Image.fromarray(self.vsselMask).save(image_path)
-
-        elif self.imageLabel.currentMask == "Macula":
-            macula_folder = os.path.join(self.current_path, "Macula")
-            print(macula_folder)
-            if not os.path.exists(macula_folder):
-                os.makedirs(macula_folder)
-            image_path = os.path.join(macula_folder, self.file_name + "_" + "M.png")
-
-            Image.fromarray(self.maculaMask).save(image_path)
-
-        elif self.imageLabel.currentMask == "Optical disk":
-            optical_folder = os.path.join(self.current_path, "Optical")
-            print(optical_folder)
-            if not os.path.exists(optical_folder):
-                os.makedirs(optical_folder)
-            image_path = os.path.join(optical_folder, self.file_name + "_" + "O.png")
-
-            Image.fromarray(self.diskMask).save(image_path)
+        for name, folder, letter, _ in LABEL_CLASSES:
+            if name == self.imageLabel.currentMask:
+                image_path = os.path.join(self.current_path, folder, self.file_name + "_" + letter + ".png")
+                # Encoding runs in the background, the UI keeps painting meanwhile
+                mask_writer().save(image_path, self.labels.mask(name), copy=False)
 
     def loadMask(self):
         filename, _ = QFileDialog.getOpenFileName(self, "Open Image", "", "Image Files (*.png)")
         if filename:
 
             self.mask_image = cv2.imread(filename, cv2.IMREAD_GRAYSCALE)
-            if self.mask_image is not None:
-                if self.imageLabel.currentMask == "Vessel network":
-                    self.vsselMask = self.mask_image
-                elif self.imageLabel.currentMask == "Macula":
-                    self.maculaMask = self.mask_image
-                elif self.imageLabel.currentMask == "Optical disk":
-                    self.diskMask = self.mask_image
+            if self.mask_image is not None and self.mask_image.shape != self.labels.shape:
+                print("Mask size does not match the image.")
+            elif self.mask_image is not None:
+                self.labels.setMask(self.imageLabel.currentMask, self.mask_image)
+                self.history.commit()
                 print("Mask loaded successfully.")
                 self.updateDisplay()
             else:
@@ -669,18 +1531,15 @@ class ImageWidget(QWidget):
                                      QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
 
         if reply == QMessageBox.Yes:
-            if self.imageLabel.currentMask == "Vessel network":
-                self.vsselMask = np.zeros(self.originalImage.shape[:2], dtype=np.uint8)
-            elif self.imageLabel.currentMask == "Macula":
-                self.maculaMask = np.zeros(self.originalImage.shape[:2], dtype=np.uint8)
-            elif self.imageLabel.currentMask == "Optical disk":
-                self.diskMask = np.zeros(self.originalImage.shape[:2], dtype=np.uint8)
+            self.labels.clear(self.imageLabel.currentMask)
+            self.history.commit()
 
         self.updateDisplay()
 
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
+    app.aboutToQuit.connect(mask_writer().flush)
     window = Menu()
     window.show()
     sys.exit(app.exec_())
\ No newline at end of file
@@ -1,2 +1,7 @@
-from .abstract     import *
-from .pst_labeling import *
\ No newline at end of file
+from .abstract        import *
+from .pst_kernels     import *
+from .pst_backends    import *
+from .pst_cache       import *
+from .pst_postprocess import *
+from .pst_preview     import *
+from .pst_labeling    import *
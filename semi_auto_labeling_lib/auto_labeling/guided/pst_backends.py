@@ -0,0 +1,431 @@
+"""PST backends.
+This module contains implementations of the Phase Stretch Transform used by PSTLabeler.
+TorchPSTBackend runs phycv's PST_GPU, NumpyPSTBackend is a pure NumPy/SciPy implementation
+of the same transform that does not need torch.
+"""
+from __future__  import annotations
+
+from abc         import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import replace
+from functools   import lru_cache
+from typing      import Optional, Tuple, List, TYPE_CHECKING
+from nptyping    import NDArray, Shape, Float32, Complex64, Number
+
+import math
+import threading
+import numpy as np
+
+if TYPE_CHECKING:
+    from torch._prims_common import DeviceLikeType
+    from .pst_kernels        import PSTKernelCache
+    from .pst_labeling       import PSTParameters
+
+    import torch
+
+
+class PSTBackendBase(ABC):
+    """Base PST backend.
+    A backend transforms a stack of grey scaled images of the same shape and returns
+    the PST output (binary edges if params.morph_flag is set, raw phase otherwise).
+
+    Methods
+    -------
+    def set_params(self, params: PSTParameters) -> None
+        stores parameters used by following transforms
+
+    @abstractmethod
+    def transform(self, images: NDArray[Shape["*, *, *"], Number]) -> NDArray[Shape["*, *, *"], Float32]
+        PST of (B, H, W) stack of images
+
+    def phase(self, images: NDArray[Shape["*, *, *"], Number]) -> NDArray[Shape["*, *, *"], Float32]
+        raw PST phase of (B, H, W) stack, before normalization and morphology (optional)
+    """
+    name:    str = ""
+    version: str = "1"  # bump when the output of the backend changes, invalidates cached results
+    bytes_per_pixel: int = 48  # approximate working memory of transform per image pixel
+    _params: Optional[PSTParameters] = None
+
+    def set_params(self, params: PSTParameters) -> None:
+        self._params = params
+
+    @abstractmethod
+    def transform(self, images: NDArray[Shape["*, *, *"], Number]) -> NDArray[Shape["*, *, *"], Float32]: ...
+
+    def phase(self, images: NDArray[Shape["*, *, *"], Number]) -> NDArray[Shape["*, *, *"], Float32]:
+        raise NotImplementedError(f"{type(self).__name__} does not provide raw PST phase")
+
+
+class TorchPSTBackend(PSTBackendBase):
+    """PST on torch device through phycv's PST_GPU. Kernels are taken from kernel_cache
+    (process wide PSTKernelCache by default), torch and phycv are imported on construction.
+    """
+    name = "torch"
+    version = "2"
+
+    def __init__(self, torch_device: Optional[DeviceLikeType]=None, kernel_cache: Optional[PSTKernelCache]=None):
+        import torch
+        from phycv        import PST_GPU # type: ignore
+        from .            import pst_kernels
+
+        if torch_device is None:
+            torch_device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self._device  = torch_device
+        self._PST     = PST_GPU(device=torch_device)
+        self._kernels = kernel_cache if kernel_cache is not None else pst_kernels.kernel_cache
+
+    def set_params(self, params: PSTParameters) -> None:
+        self._params = params
+        if self._PST.h and self._PST.w:
+            self._load_kernel()
+
+    def transform(self, images: NDArray[Shape["*, *, *"], Number]) -> NDArray[Shape["*, *, *"], Float32]:
+        import torch
+
+        assert self._params is not None, "use .set_params before transforming images"
+        self._ensure_kernel(images.shape[1:])
+        stacked = torch.from_numpy(np.ascontiguousarray(images)).to(self._device).float()
+        return self._apply_kernel_batch(stacked).cpu().numpy()
+
+    def phase(self, images: NDArray[Shape["*, *, *"], Number]) -> NDArray[Shape["*, *, *"], Float32]:
+        import torch
+
+        assert self._params is not None, "use .set_params before transforming images"
+        self._ensure_kernel(images.shape[1:])
+        self._PST.img = torch.from_numpy(np.ascontiguousarray(images)).to(self._device).float()
+        self._PST.apply_kernel(self._params.sigma_LPF, None, None, False)
+        return torch.angle(self._PST.img_pst).cpu().numpy()
+
+    def _ensure_kernel(self, shape: Tuple[int, ...]) -> None:
+        if shape[0] != self._PST.h or shape[1] != self._PST.w:
+            self._PST.h = shape[0]
+            self._PST.w = shape[1]
+            self._load_kernel()
+
+    def _load_kernel(self) -> None:
+        assert self._params is not None
+        self._kernels.load_into( self._PST,
+                                 S = self._params.phase_strength,
+                                 W = self._params.warp_strength  )
+
+    def _apply_kernel_batch(self, images: torch.Tensor) -> torch.Tensor:
+        """PST of a (B, H, W) stack. phycv's transform works over the last two dimensions,
+        so it runs on the whole stack. phycv normalizes the phase over the whole stack, so the
+        normalization and the morphology are done here per image.
+        """
+        import torch
+
+        assert self._params is not None
+        self._PST.img = images
+        self._PST.apply_kernel(self._params.sigma_LPF, None, None, False)
+        phase = torch.angle(self._PST.img_pst)
+        if not self._params.morph_flag:
+            return _normalize_batch(phase)
+        return _morph_batch(images, phase, self._params.thresh_min, self._params.thresh_max) # type: ignore
+
+
+class NumpyPSTBackend(PSTBackendBase):
+    """PST with scipy.fft in float32, without torch, following phycv's math.
+    The low-pass and phase kernels are merged into one complex filter per (shape, parameters),
+    so each image needs a single rfft2 and ifft2.
+
+    Parameters
+    ----------
+    workers : int, optional
+        Number of threads used by scipy.fft, all cores by default
+    max_filters : int
+        Number of filters kept in the backend's LRU
+    """
+    name = "numpy"
+    version = "3"
+    bytes_per_pixel = 40
+
+    def __init__(self, workers: Optional[int] = None, max_filters: int = 8):
+        self.workers     = workers if workers is not None else -1
+        self.max_filters = max_filters
+        self._filters: OrderedDict[tuple, NDArray[Shape["*, *"], Complex64]] = OrderedDict()
+        self._filters_lock = threading.Lock()
+
+    def transform(self, images: NDArray[Shape["*, *, *"], Number]) -> NDArray[Shape["*, *, *"], Float32]:
+        assert self._params is not None, "use .set_params before transforming images"
+        phase = self.phase(images)
+        if not self._params.morph_flag:
+            return normalize(phase)
+        return morph(images, phase, self._params.thresh_min, self._params.thresh_max)
+
+    def phase(self, images: NDArray[Shape["*, *, *"], Number]) -> NDArray[Shape["*, *, *"], Float32]:
+        from scipy import fft # type: ignore
+
+        assert self._params is not None, "use .set_params before transforming images"
+        h, w    = images.shape[1:]
+        spectra = _full_spectrum(fft.rfft2(images.astype(np.float32, copy=False), workers=self.workers), w)
+        spectra *= self._filter(h, w)
+        return np.angle(fft.ifft2(spectra, workers=self.workers, overwrite_x=True)).astype(np.float32)
+
+    def _filter(self, h: int, w: int) -> NDArray[Shape["*, *"], Complex64]:
+        assert self._params is not None
+        p   = self._params
+        key = (h, w, p.phase_strength, p.warp_strength, p.sigma_LPF)
+        with self._filters_lock:
+            filt = self._filters.get(key)
+            if filt is not None:
+                self._filters.move_to_end(key)
+                return filt
+
+        filt = pst_filter(h, w, p.phase_strength, p.warp_strength, p.sigma_LPF)
+        with self._filters_lock:
+            self._filters[key] = filt
+            while len(self._filters) > self.max_filters:
+                self._filters.popitem(last=False)
+        return filt
+
+
+def pst_filter( h: int, w: int, phase_strength: float, warp_strength: float,
+                sigma_LPF: float ) -> NDArray[Shape["*, *"], Complex64]:
+    """Low-pass filter and PST kernel of phycv merged into one complex filter in FFT order
+    """
+    u = np.linspace(-0.5, 0.5, h, dtype=np.float32)
+    v = np.linspace(-0.5, 0.5, w, dtype=np.float32)
+    rho = np.hypot(u[:, None], v[None, :])
+    rw  = rho * warp_strength
+    kernel = rw * np.arctan(rw) - 0.5 * np.log1p(rw ** 2)
+    kernel = phase_strength * kernel / kernel.max()
+    lpf = np.exp(-0.5 * (rho / math.sqrt(sigma_LPF ** 2 / math.log(2))) ** 2)
+    return np.fft.fftshift(lpf * np.exp(-1j * kernel)).astype(np.complex64)
+
+
+@lru_cache(maxsize=64)
+def kernel_radius( phase_strength: float, warp_strength: float, sigma_LPF: float,
+                   tolerance: float = 5e-4, size: int = 1024 ) -> int:
+    """Radius in pixels of the PST impulse response, all but tolerance of its absolute value lies within it.
+    The response of strong warps decays slowly, so the radius is often tens to hundreds of pixels.
+    """
+    response = np.abs(np.fft.ifft2(pst_filter(size, size, phase_strength, warp_strength, sigma_LPF)))
+    offsets  = np.fft.fftfreq(size) * size
+    radii    = np.hypot(offsets[:, None], offsets[None, :]).astype(int)
+    mass     = np.bincount(radii.ravel(), weights=response.ravel())
+    tail     = 1 - np.cumsum(mass) / mass.sum()
+    return int(np.argmax(tail <= tolerance))
+
+
+class TiledPSTBackend(PSTBackendBase):
+    """PST of large images in overlapping tiles, FFT working memory is bounded by the tile size.
+    The raw PST phase of every tile (tile_size plus halo on each side, image borders reflected)
+    is computed by the inner backend, tiles are blended with linear feathering over the overlap,
+    so circular FFT artifacts at tile borders get no weight. Normalization and the morphological
+    operation then run once on the blended phase, with extremes and quantiles of the whole image.
+
+    Parameters
+    ----------
+    inner : PSTBackendBase
+        backend transforming the tiles, it has to provide raw phase (.phase) and be thread safe
+        if n_threads > 1 (NumpyPSTBackend is)
+    tile_size : int
+        side of the tile core, ignored if peak_memory_mb is given
+    halo : int, optional
+        overlap added on each side of a tile, it should cover the spatial extent of the PST kernel.
+        By default it is derived from the parameters with kernel_radius (rounded up to 32 pixels,
+        at most the tile size), so every set_params may change halo and tile_size
+    peak_memory_mb : float, optional
+        working memory of tile transforms, tile_size is derived from it. It is a tile size hint, not
+        a bound of the whole transform: the blended phase, the output and the temporaries of normalization
+        and morphology are full image arrays, up to full_image_bytes_per_pixel on top of the budget
+    n_threads : int
+        tiles transformed in parallel
+    halo_tolerance : float
+        tolerance of kernel_radius for the derived halo
+    """
+    name = "tiled"
+    version = "2"
+    full_image_bytes_per_pixel = 16  # blended phase, output, quantile copy and masks of morph
+
+    def __init__( self, inner: PSTBackendBase, tile_size: int = 1024, halo: Optional[int] = None,
+                  peak_memory_mb: Optional[float] = None, n_threads: int = 1, halo_tolerance: float = 5e-4 ):
+        if type(inner).phase is PSTBackendBase.phase:
+            raise ValueError(f"{type(inner).__name__} does not provide raw PST phase, normalized tiles cannot be blended")
+        if n_threads > 1 and isinstance(inner, TorchPSTBackend):
+            raise ValueError("TorchPSTBackend is not thread safe, use n_threads=1 or NumpyPSTBackend")
+        self.inner          = inner
+        self.n_threads      = n_threads
+        self.peak_memory_mb = peak_memory_mb
+        self.halo_tolerance = halo_tolerance
+        self._tile_size     = tile_size
+        self._halo          = halo
+        self.tile_size      = tile_size
+        self.halo           = halo
+        if halo is not None:
+            self._layout(halo)
+
+    def _layout(self, halo: int) -> None:
+        """Sets halo, tile_size and version of the tiling"""
+        tile_size = self._tile_size
+        if self.peak_memory_mb is not None:
+            window    = math.isqrt(int(self.peak_memory_mb * 2**20 / (self.n_threads * self.inner.bytes_per_pixel)))
+            tile_size = (window - 2*halo) // 64 * 64
+        if tile_size < max(halo, 64):
+            raise ValueError(f"tile size {tile_size} is too small for halo {halo}, raise peak_memory_mb or lower halo")
+        self.tile_size = tile_size
+        self.halo      = halo
+        self.version   = f"{TiledPSTBackend.version}/{self.inner.name}/{self.inner.version}/{tile_size}/{halo}"
+
+    def _max_halo(self) -> int:
+        if self.peak_memory_mb is None:
+            return self._tile_size
+        window = math.isqrt(int(self.peak_memory_mb * 2**20 / (self.n_threads * self.inner.bytes_per_pixel)))
+        return window // 3 // 64 * 64
+
+    def set_params(self, params: PSTParameters) -> None:
+        import warnings
+
+        self._params = params
+        if self._halo is None:
+            radius = kernel_radius(params.phase_strength, params.warp_strength, params.sigma_LPF, self.halo_tolerance)
+            self._layout(min(max(-(-radius // 32) * 32, 32), self._max_halo()))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            self.inner.set_params(replace(params, morph_flag=False, thresh_min=None, thresh_max=None))
+
+    def transform(self, images: NDArray[Shape["*, *, *"], Number]) -> NDArray[Shape["*, *, *"], Float32]:
+        assert self._params is not None, "use .set_params before transforming images"
+        out = np.empty(images.shape, dtype=np.float32)
+        for ii, image in enumerate(images):
+            self._phase(image, out[ii])
+        if not self._params.morph_flag:
+            return normalize(out)
+        return morph(images, out, self._params.thresh_min, self._params.thresh_max)
+
+    def _phase(self, image: NDArray[Shape["*, *"], Number], phase: NDArray[Shape["*, *"], Float32]) -> None:
+        """Blends raw phase of the tiles into phase (float32 array of the image shape)"""
+        h, w  = image.shape
+        halo  = self.halo
+        ys, wy = self._windows(h)
+        xs, wx = self._windows(w)
+        padded = np.pad(image, halo, mode="reflect") if halo else image
+        phase[...] = 0
+
+        def run(origin: Tuple[int, int]) -> None:
+            # all windows have the same shape, so the inner backend builds its kernel once
+            y0, x0 = origin
+            tile = self.inner.phase(padded[None, y0:y0 + len(wy), x0:x0 + len(wx)])[0]
+            rows = slice(max(y0 - halo, 0), min(y0 - halo + len(wy), h))
+            cols = slice(max(x0 - halo, 0), min(x0 - halo + len(wx), w))
+            ty   = slice(rows.start - (y0 - halo), rows.stop - (y0 - halo))
+            tx   = slice(cols.start - (x0 - halo), cols.stop - (x0 - halo))
+            weighted = tile[ty, tx] * wy[ty, None] * wx[None, tx]
+            with lock:
+                phase[rows, cols] += weighted
+
+        lock    = threading.Lock()
+        origins = [(y0, x0) for y0 in ys for x0 in xs]
+        if self.n_threads > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(self.n_threads) as pool:
+                list(pool.map(run, origins))
+        else:
+            for origin in origins:
+                run(origin)
+
+        # feather weights are separable, so their sum over all tiles is the outer product of 1D sums
+        phase /= self._weight_sum(h, ys, wy)[:, None]
+        phase /= self._weight_sum(w, xs, wx)[None, :]
+
+    def _windows(self, n: int) -> Tuple[List[int], NDArray]:
+        """Window starts in padded coordinates and the feather weights of one window along an axis of length n"""
+        length = min(self.tile_size + 2*self.halo, n + 2*self.halo)
+        starts = []
+        for core in range(0, n, self.tile_size):
+            start = min(core, n + 2*self.halo - length)
+            if not starts or start > starts[-1]:
+                starts.append(start)
+        ramp    = max(2*self.halo, 1)
+        weights = np.clip((np.minimum(np.arange(length), length - 1 - np.arange(length)) + 0.5) / ramp, 0, 1)
+        return starts, weights.astype(np.float32)
+
+    def _weight_sum(self, n: int, starts: List[int], weights: NDArray) -> NDArray:
+        total = np.zeros(n + 2*self.halo, dtype=np.float32)
+        for start in starts:
+            total[start:start + len(weights)] += weights
+        return total[self.halo:self.halo + n]
+
+
+def _full_spectrum(half: NDArray, w: int) -> NDArray:
+    """Full 2D spectrum of real input from its rfft2 along the last two axes (Hermitian symmetry)"""
+    h    = half.shape[-2]
+    full = np.empty(half.shape[:-1] + (w,), dtype=half.dtype)
+    full[..., :half.shape[-1]] = half
+    cols = np.arange(half.shape[-1], w)
+    if len(cols):
+        rows = (-np.arange(h)) % h
+        full[..., cols] = np.conj(half[..., rows, :][..., w - cols])
+    return full
+
+
+def normalize(features: NDArray[Shape["*, *, *"], Float32]) -> NDArray[Shape["*, *, *"], Float32]:
+    """Min-max normalization to [0, 1] per image of the stack, as phycv's normalize
+    """
+    flat = features.reshape(len(features), -1)
+    lo   = flat.min(axis=1)[:, None, None]
+    hi   = flat.max(axis=1)[:, None, None]
+    return (features - lo) / np.maximum(hi - lo, np.finfo(np.float32).tiny)
+
+
+def morph( images:   NDArray[Shape["*, *, *"], Number],
+           features: NDArray[Shape["*, *, *"], Float32],
+           thresh_min: float, thresh_max: float ) -> NDArray[Shape["*, *, *"], Float32]:
+    """Quantile thresholding of PST phase as in phycv's morphological operation, per image of the stack.
+    As in phycv, quantiles are taken of every 4th pixel in both directions.
+    """
+    flat  = features[:, ::4, ::4].reshape(len(features), -1)
+    q_min, q_max = np.quantile(flat, [thresh_min, thresh_max], axis=1)[:, :, None, None]
+    digital = (features > q_max) | (features < q_min)
+    bright  = images >= images.reshape(len(images), -1).max(axis=1)[:, None, None] / 20
+    return (digital & bright).astype(np.float32)
+
+
+def _quantile_batch(flat: torch.Tensor, q: float) -> torch.Tensor:
+    """Per-row linear interpolated quantile of (B, N) tensor. Unlike torch.quantile
+    it has no input size limit, which full resolution stacks easily exceed.
+    """
+    import torch
+
+    pos = q * (flat.shape[1] - 1)
+    lo  = int(math.floor(pos))
+    hi  = min(lo + 1, flat.shape[1] - 1)
+    v_lo = torch.kthvalue(flat, lo + 1, dim=1).values
+    v_hi = torch.kthvalue(flat, hi + 1, dim=1).values
+    return v_lo + (pos - lo) * (v_hi - v_lo)
+
+
+def _normalize_batch(features: torch.Tensor) -> torch.Tensor:
+    """Torch version of normalize, min-max per image of the stack
+    """
+    import torch
+
+    flat = features.flatten(1)
+    lo   = flat.amin(dim=1).view(-1, 1, 1)
+    hi   = flat.amax(dim=1).view(-1, 1, 1)
+    return (features - lo) / (hi - lo).clamp_min(torch.finfo(features.dtype).tiny)
+
+
+def _morph_batch(images: torch.Tensor, features: torch.Tensor, thresh_min: float, thresh_max: float) -> torch.Tensor:
+    """Torch version of morph, runs on the device of the stack
+    """
+    flat = features[:, ::4, ::4].flatten(1)
+    q_min = _quantile_batch(flat, thresh_min).view(-1, 1, 1)
+    q_max = _quantile_batch(flat, thresh_max).view(-1, 1, 1)
+    digital = (features > q_max) | (features < q_min)
+    bright  = images >= images.flatten(1).amax(dim=1).view(-1, 1, 1) / 20
+    return (digital & bright).float()
+
+
+def make_backend( backend: str | PSTBackendBase = "torch",
+                  torch_device: Optional[DeviceLikeType] = None,
+                  kernel_cache: Optional[PSTKernelCache] = None ) -> PSTBackendBase:
+    """Returns backend instance for name ("torch" or "numpy") or the backend itself"""
+    if isinstance(backend, PSTBackendBase):
+        return backend
+    if backend == "torch":
+        return TorchPSTBackend(torch_device, kernel_cache)
+    if backend == "numpy":
+        return NumpyPSTBackend()
+    raise ValueError(f"unknown PST backend {backend!r}, use 'torch', 'numpy' or PSTBackendBase instance")
@@ -0,0 +1,157 @@
+"""On-disk cache of PST results.
+Entries are keyed by hash of the image content, PST parameters and backend version, so reopening
+an already processed image loads its PST output (and post-processed masks) instead of recomputing them.
+"""
+from __future__  import annotations
+
+from typing      import Optional, Mapping, TYPE_CHECKING
+from nptyping    import NDArray
+
+import hashlib
+import json
+import os
+import threading
+import zipfile
+import numpy as np
+
+if TYPE_CHECKING:
+    from .pst_backends import PSTBackendBase
+
+default_cache_folder = os.path.join(os.path.expanduser("~"), ".cache", "auto_labeling", "pst_results")
+
+
+class PSTResultCache:
+    """LRU cache of PST outputs and masks stored as compressed npz files.
+    Binary 0/255 masks are bit-packed before compression. When the folder grows over max_bytes,
+    least recently used entries are removed (file modification time serves as last access).
+
+    Parameters
+    ----------
+    folder : str, optional
+        cache folder, ~/.cache/auto_labeling/pst_results by default
+    max_bytes : int
+        disk quota of the cache
+    """
+
+    def __init__(self, folder: Optional[str] = None, max_bytes: int = 1024 * 1024 * 1024):
+        self.folder      = os.path.expanduser(folder or default_cache_folder)
+        self.max_bytes   = max_bytes
+        self.total_bytes: Optional[int] = None
+        self.hits        = 0
+        self.misses      = 0
+        self._lock       = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+
+    @staticmethod
+    def key(image: NDArray, params: Mapping, backend: PSTBackendBase | str, flag_raw: bool = False) -> str:
+        """sha256 of image content, parameters and backend version"""
+        digest = hashlib.sha256()
+        image  = np.ascontiguousarray(image)
+        digest.update(f"{image.shape}{image.dtype}".encode())
+        digest.update(memoryview(image).cast("B"))
+        version = backend if isinstance(backend, str) else f"{backend.name}/{backend.version}"
+        digest.update(json.dumps({ "params": {k: _json_value(params[k]) for k in params.keys()},
+                                   "backend": version, "raw": flag_raw }, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def path(self, key: str, name: str = "output") -> str:
+        return os.path.join(self.folder, f"{key}_{name}.npz")
+
+    def get(self, key: str, name: str = "output") -> Optional[NDArray]:
+        """Returns stored array or None"""
+        path = self.path(key, name)
+        try:
+            with np.load(path) as data:
+                array = _decode(data)
+            os.utime(path)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            if not isinstance(e, FileNotFoundError):
+                # corrupted entry (e.g. truncated by a crash), drop it so that it is recomputed
+                self._remove(path)
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return array
+
+    def put(self, key: str, array: NDArray, name: str = "output") -> None:
+        path = self.path(key, name)
+        try:
+            old_bytes = os.path.getsize(path)
+        except OSError:
+            old_bytes = 0
+        # not *.npz, so that evict of other processes sharing the folder does not count or remove it
+        tmp  = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                np.savez_compressed(f, **_encode(array))
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        with self._lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(entry.stat().st_size for entry in os.scandir(self.folder)
+                                       if entry.name.endswith(".npz") and entry.is_file())
+            else:
+                self.total_bytes += os.path.getsize(path) - old_bytes
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self) -> None:
+        self.total_bytes = evict_lru(self.folder, ".npz", self.max_bytes)
+
+    def _remove(self, path: str) -> None:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            if self.total_bytes is not None:
+                self.total_bytes -= size
+
+
+def evict_lru(folder: str, suffix: str, max_bytes: int, fill: float = 0.9) -> int:
+    """Removes least recently used files ending with suffix from folder until they fit into fill * max_bytes.
+    File modification time serves as last access, readers of the cache are expected to touch it.
+    Shrinking below the quota makes eviction not run on every put.
+
+    Returns
+    -------
+    int
+        total size of the remaining files
+    """
+    entries = sorted((entry for entry in os.scandir(folder) if entry.name.endswith(suffix) and entry.is_file()),
+                     key=lambda entry: entry.stat().st_mtime)
+    total_bytes = sum(entry.stat().st_size for entry in entries)
+    for entry in entries:
+        if total_bytes <= fill * max_bytes:
+            break
+        try:
+            os.remove(entry.path)
+            total_bytes -= entry.stat().st_size
+        except OSError:
+            pass
+    return total_bytes
+
+
+def _json_value(value):
+    """parameter value for the key, numbers as float so that 20 and 20.0 give the same key"""
+    if value is None or isinstance(value, bool):
+        return value
+    return float(value)
+
+def _encode(array: NDArray) -> dict:
+    if array.dtype == np.uint8 and not np.any((array != 0) & (array != 255)):
+        return {"packed": np.packbits(array > 0), "shape": np.array(array.shape)}
+    return {"array": array}
+
+def _decode(data) -> NDArray:
+    if "packed" in data:
+        shape = tuple(data["shape"])
+        return np.unpackbits(data["packed"], count=int(np.prod(shape))).reshape(shape) * np.uint8(255)
+    return data["array"]
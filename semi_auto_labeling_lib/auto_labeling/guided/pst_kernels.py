@@ -0,0 +1,124 @@
+"""Cache of PST kernels.
+Building the PST kernel (RHO, THETA and the phase kernel) is the expensive part of changing
+image shape or PST parameters. Kernels are cached in a process wide LRU shared by all labelers.
+"""
+
+from __future__  import annotations
+
+from collections import OrderedDict
+from typing      import Optional, Tuple, Dict, TYPE_CHECKING
+
+import os
+import threading
+
+if TYPE_CHECKING:
+    from phycv               import PST_GPU # type: ignore
+    from torch._prims_common import DeviceLikeType
+
+    import torch
+
+KernelKey = Tuple[int, int, float, float, str, str]
+
+
+class PSTKernelCache:
+    """LRU cache of PST kernels keyed by (h, w, phase_strength, warp_strength, dtype, device).
+
+    Parameters
+    ----------
+    max_bytes : int
+        Memory cap for cached tensors, least recently used kernels are dropped above it
+    cache_dir : str, optional
+        If given, kernels are also persisted to this folder and loaded from it on a memory miss
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, cache_dir: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.cache_dir = os.path.expanduser(cache_dir) if cache_dir else None
+        self.hits      = 0
+        self.misses    = 0
+        self.disk_hits = 0
+        self._nbytes   = 0
+        self._entries: OrderedDict[KernelKey, Dict[str, torch.Tensor]] = OrderedDict()
+        self._lock     = threading.Lock()
+
+    @staticmethod
+    def key(h: int, w: int, S: float, W: float, device: DeviceLikeType) -> KernelKey:
+        import torch
+
+        return (int(h), int(w), float(S), float(W), str(torch.get_default_dtype()), str(torch.device(device)))
+
+    def load_into(self, pst: PST_GPU, S: float, W: float) -> None:
+        """Sets RHO, THETA and pst_kernel of pst (with h and w set) to the kernel for S, W,
+        building it with pst.init_kernel only when it is not cached.
+        """
+        key = self.key(pst.h, pst.w, S, W, pst.device)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        if entry is None:
+            entry = self._load_disk(key, pst.device)
+            if entry is None:
+                pst.init_kernel(S=S, W=W)
+                entry = {"RHO": pst.RHO, "THETA": pst.THETA, "pst_kernel": pst.pst_kernel}
+                self._save_disk(key, entry)
+            with self._lock:
+                self.misses += 1
+                self._insert(key, entry)
+        pst.RHO        = entry["RHO"]
+        pst.THETA      = entry["THETA"]
+        pst.pst_kernel = entry["pst_kernel"]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return { "hits": self.hits, "misses": self.misses, "disk_hits": self.disk_hits,
+                     "entries": len(self._entries), "bytes": self._nbytes }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def _insert(self, key: KernelKey, entry: Dict[str, torch.Tensor]) -> None:
+        if key in self._entries:
+            return
+        size = sum(t.element_size() * t.nelement() for t in entry.values())
+        self._entries[key] = entry
+        self._nbytes += size
+        while self._nbytes > self.max_bytes and len(self._entries) > 1:
+            _, old = self._entries.popitem(last=False)
+            self._nbytes -= sum(t.element_size() * t.nelement() for t in old.values())
+
+    def _path(self, key: KernelKey) -> str:
+        h, w, S, W, dtype, _ = key
+        name = f"pst_{h}x{w}_S{S:g}_W{W:g}_{dtype.replace('torch.', '')}.pt"
+        return os.path.join(self.cache_dir, name) # type: ignore
+
+    def _load_disk(self, key: KernelKey, device: DeviceLikeType) -> Optional[Dict[str, torch.Tensor]]:
+        if self.cache_dir is None:
+            return None
+        import torch
+
+        try:
+            entry = torch.load(self._path(key), map_location=device)
+        except (OSError, RuntimeError, EOFError):
+            return None
+        with self._lock:
+            self.disk_hits += 1
+        return entry
+
+    def _save_disk(self, key: KernelKey, entry: Dict[str, torch.Tensor]) -> None:
+        if self.cache_dir is None:
+            return
+        import torch
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        tmp  = f"{path}.{os.getpid()}.tmp"
+        torch.save({k: t.cpu() for k, t in entry.items()}, tmp)
+        os.replace(tmp, path)
+
+
+kernel_cache = PSTKernelCache()
+"""Process wide cache used by PSTLabeler instances unless another cache is given"""
@@ -0,0 +1,136 @@
+"""Post-processing of PST masks.
+MaskReconstructor runs the closing, dilation and median blur of PSTResult.mask_reconstruction
+with cached structuring elements and reused buffers, only on the bounding box of the foreground,
+optionally split into row bands processed in parallel.
+"""
+from __future__  import annotations
+
+from functools   import lru_cache
+from typing      import Optional, Tuple, List
+from nptyping    import NDArray, Shape, UInt8
+
+import os
+import threading
+import numpy as np
+
+_pool      = None
+_pool_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def ellipse_kernel(ksize: int) -> NDArray[Shape["*, *"], UInt8]:
+    """Read-only elliptic structuring element of size ksize x ksize"""
+    from cv2 import getStructuringElement, MORPH_ELLIPSE
+
+    kernel = getStructuringElement(MORPH_ELLIPSE, (ksize, ksize))
+    kernel.setflags(write=False)
+    return kernel
+
+
+def _band_pool():
+    """Thread pool shared by all MaskReconstructors, created on first parallel call and never shut down,
+    so reconstructors dropped from the mask_reconstructor cache leave no idle threads behind"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _pool = ThreadPoolExecutor(os.cpu_count() or 1, thread_name_prefix="MaskReconstructor")
+    return _pool
+
+
+class MaskReconstructor:
+    """Closing with ellipse of ksize_closing, dilation with 3x3 ellipse and median blur of ksize_median.
+
+    Pixels farther than margin = ksize_closing + 2 + ksize_median from the foreground cannot change,
+    so with roi only the bounding box of the foreground plus margin is processed, and row bands
+    overlapping by margin give the same result as one pass over the whole mask.
+    Intermediate buffers are kept per thread and reused while the processed shape does not change,
+    bands run on a thread pool shared by all instances.
+
+    Parameters
+    ----------
+    ksize_closing : int
+        kernel size of the closing
+    ksize_median : int
+        kernel size of the median blur
+    roi : bool
+        process only the bounding box of the foreground
+    n_threads : int
+        row bands processed in parallel
+    min_band_rows : int
+        masks with fewer rows per band are processed in one pass
+    """
+
+    def __init__( self, ksize_closing: int = 15, ksize_median: int = 7, roi: bool = True,
+                  n_threads: int = 1, min_band_rows: int = 256 ):
+        self.ksize_closing = ksize_closing
+        self.ksize_median  = ksize_median
+        self.roi           = roi
+        self.n_threads     = n_threads
+        self.min_band_rows = min_band_rows
+        self.margin        = ksize_closing + 2 + ksize_median
+        self._kernel       = ellipse_kernel(ksize_closing)
+        self._kernel_sm    = ellipse_kernel(3)
+        self._local        = threading.local()
+
+    def __call__( self, mask: NDArray[Shape["*, *"], UInt8],
+                  out: Optional[NDArray[Shape["*, *"], UInt8]] = None ) -> NDArray[Shape["*, *"], UInt8]:
+        """Returns reconstructed mask, written to out if given (out must not be mask)"""
+        h, w = mask.shape
+        if self.roi:
+            from cv2 import boundingRect
+
+            x, y, bw, bh = boundingRect(mask)
+            if bw == 0 or bh == 0:
+                if out is None:
+                    return np.zeros_like(mask)
+                out[...] = 0
+                return out
+            y0, y1 = max(y - self.margin, 0), min(y + bh + self.margin, h)
+            x0, x1 = max(x - self.margin, 0), min(x + bw + self.margin, w)
+        else:
+            y0, y1, x0, x1 = 0, h, 0, w
+
+        if out is None:
+            out = np.zeros_like(mask)
+        elif (y0, y1, x0, x1) != (0, h, 0, w):
+            out[...] = 0
+
+        bands = self._bands(y0, y1)
+        if len(bands) == 1:
+            self._process(mask, out, bands[0], x0, x1)
+        else:
+            list(_band_pool().map(lambda band: self._process(mask, out, band, x0, x1), bands))
+        return out
+
+    def _bands(self, y0: int, y1: int) -> List[Tuple[int, int, int, int]]:
+        """(source start, core start, core end, source end) rows of every band"""
+        n_bands = max(min(self.n_threads, (y1 - y0) // self.min_band_rows), 1)
+        cuts = np.linspace(y0, y1, n_bands + 1).astype(int)
+        return [ (max(c0 - self.margin, y0), c0, c1, min(c1 + self.margin, y1))
+                 for c0, c1 in zip(cuts[:-1], cuts[1:]) ]
+
+    def _buffers(self, shape: Tuple[int, int]) -> Tuple[NDArray, NDArray]:
+        buffers = getattr(self._local, "buffers", None)
+        if buffers is None or buffers[0].shape != shape:
+            buffers = (np.empty(shape, dtype=np.uint8), np.empty(shape, dtype=np.uint8))
+            self._local.buffers = buffers
+        return buffers
+
+    def _process( self, mask: NDArray, out: NDArray, band: Tuple[int, int, int, int], x0: int, x1: int ) -> None:
+        from cv2 import morphologyEx, dilate, medianBlur, MORPH_CLOSE
+
+        s0, c0, c1, s1 = band
+        src  = mask[s0:s1, x0:x1]
+        a, b = self._buffers(src.shape)
+        # ping-pong between two buffers, opencv returns a new array only if dst does not fit
+        a = morphologyEx(src, MORPH_CLOSE, self._kernel, dst=a)
+        b = dilate(a, self._kernel_sm, dst=b, iterations=1)
+        a = medianBlur(b, self.ksize_median, dst=a)
+        out[c0:c1, x0:x1] = a[c0 - s0:c1 - s0]
+
+
+@lru_cache(maxsize=16)
+def mask_reconstructor(ksize_closing: int = 15, ksize_median: int = 7, roi: bool = True, n_threads: int = 1) -> MaskReconstructor:
+    """Shared MaskReconstructor for the configuration, buffers are per thread so it can be used concurrently"""
+    return MaskReconstructor(ksize_closing, ksize_median, roi, n_threads)
@@ -0,0 +1,157 @@
+"""Progressive PST preview for interactive parameter tuning.
+A quick preview is computed on a downsampled copy of the image (or on the visible viewport only),
+the full resolution result follows from a background thread. Every parameter change starts a new
+generation and refinements of older generations are dropped.
+"""
+from __future__         import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses        import dataclass
+from typing             import Callable, Mapping, Optional, Tuple, TYPE_CHECKING
+
+import threading
+import numpy as np
+
+from .pst_labeling import PSTLabeler, PSTParameters, PSTResult
+
+if TYPE_CHECKING:
+    from cv2.typing          import MatLike
+    from torch._prims_common import DeviceLikeType
+
+
+@dataclass
+class PSTPreview:
+    """PST result of one generation.
+
+    Attributes
+    ----------
+    result : PSTResult
+        result for the previewed region
+    generation : int
+        generation of parameters it was computed with
+    scale : float
+        size of one result pixel in full resolution pixels (1 for refined results)
+    origin : Tuple[int, int]
+        (x, y) of the region in full resolution image
+    final : bool
+        True for full resolution result of the whole image
+    """
+    result:     PSTResult
+    generation: int
+    scale:      float
+    origin:     Tuple[int, int]
+    final:      bool
+
+
+class ProgressivePSTPreview:
+    """Coarse to fine PST for parameter tuning.
+
+    Parameters
+    ----------
+    backend : str
+        PST backend of both labelers ("numpy" or "torch"), each thread uses its own labeler
+    preview_size : int
+        longer side of the downsampled image used for previews
+    on_refined : callable, optional
+        called from the worker thread with PSTPreview of the full resolution result
+    torch_device : optional
+        device of the torch backend
+    """
+
+    def __init__( self, backend: str = "numpy", preview_size: int = 512,
+                  on_refined: Optional[Callable[[PSTPreview], None]] = None,
+                  torch_device: Optional[DeviceLikeType] = None ):
+        self.preview_size = preview_size
+        self.on_refined   = on_refined
+        self._preview_labeler = PSTLabeler(torch_device, backend=backend)
+        self._refine_labeler  = PSTLabeler(torch_device, backend=backend)
+        self._executor   = ThreadPoolExecutor(max_workers=1, thread_name_prefix="PSTRefine")
+        self._lock       = threading.Lock()
+        self._generation = 0
+        self._image:   Optional[MatLike] = None
+        self._small:   Optional[MatLike] = None
+        self._scale    = 1.0
+        self._refined: Optional[PSTPreview] = None
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    @property
+    def refined(self) -> Optional[PSTPreview]:
+        """the full resolution result of the current generation, None until it is computed"""
+        with self._lock:
+            refined = self._refined
+        return refined if refined is not None and refined.generation == self._generation else None
+
+    def set_image(self, image: MatLike) -> None:
+        """Sets the image to tune parameters on, a downsampled copy is prepared once"""
+        from cv2 import cvtColor, resize, COLOR_BGR2GRAY, INTER_AREA
+
+        self.cancel()
+        if image.ndim == 3:
+            image = cvtColor(image, COLOR_BGR2GRAY)
+        self._image = image
+        self._scale = max(image.shape[:2]) / self.preview_size
+        if self._scale > 1:
+            size = (max(round(image.shape[1] / self._scale), 1), max(round(image.shape[0] / self._scale), 1))
+            self._small = resize(image, size, interpolation=INTER_AREA)
+        else:
+            self._scale = 1.0
+            self._small = image
+
+    def update( self, parameters: PSTParameters | Mapping,
+                viewport: Optional[Tuple[int, int, int, int]] = None, refine: bool = True ) -> PSTPreview:
+        """Returns preview for new parameters and schedules full resolution refinement.
+        With viewport (x0, y0, x1, y1) the preview is the full resolution crop of the viewport,
+        otherwise the downsampled image. Pending refinements of previous parameters are cancelled.
+        """
+        assert self._image is not None, "use .set_image before updating parameters"
+        params = PSTParameters(**parameters)
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+
+        self._preview_labeler.set_params(params)
+        if viewport is not None:
+            x0, y0, x1, y1 = viewport
+            h, w = self._image.shape[:2]
+            x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, w), min(y1, h)
+            preview = PSTPreview( self._preview_labeler.apply(np.ascontiguousarray(self._image[y0:y1, x0:x1])),
+                                  generation, 1.0, (x0, y0), False )
+        else:
+            preview = PSTPreview( self._preview_labeler.apply(self._small), generation, self._scale, (0, 0),
+                                  self._scale == 1.0 )
+
+        if preview.final:
+            with self._lock:
+                self._refined = preview
+        elif refine:
+            self._executor.submit(self._refine, params, generation)
+        return preview
+
+    def cancel(self) -> None:
+        """Drops the pending refinement, a transform already running finishes but is discarded"""
+        with self._lock:
+            self._generation += 1
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[PSTPreview]:
+        """Blocks until refinements submitted so far are done, returns the refined result"""
+        self._executor.submit(lambda: None).result(timeout)
+        return self.refined
+
+    def close(self) -> None:
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+    def _refine(self, params: PSTParameters, generation: int) -> None:
+        if generation != self._generation:
+            return
+        self._refine_labeler.set_params(params)
+        refined = PSTPreview(self._refine_labeler.apply(self._image), generation, 1.0, (0, 0), True) # type: ignore
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._refined = refined
+        if self.on_refined is not None:
+            self.on_refined(refined)
@@ -1 +1,18 @@
-from .ultils import *
\ No newline at end of file
+"""Neural network based estimation of labeler parameters.
+Torch and onnxruntime are loaded on first access to an estimator, not on package import.
+"""
+
+_lazy = { "PSTParametersEstimator":  "ultils",
+          "load_model":              "ultils",
+          "clear_models":            "ultils",
+          "ONNXParametersEstimator": "onnx_estimator",
+          "export_onnx":             "onnx_estimator" }
+
+__all__ = list(_lazy)
+
+
+def __getattr__(name):
+    if name in _lazy:
+        from importlib import import_module
+        return getattr(import_module(f".{_lazy[name]}", __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,107 @@
+"""ONNX Runtime inference path for parameter estimation.
+The scripted torch model is exported to ONNX once (optionally int8 dynamic quantized) and cached,
+afterwards estimation needs only onnxruntime and numpy.
+"""
+from __future__          import annotations
+
+from typing              import Optional, Tuple
+from nptyping            import NDArray, Shape, UInt8, Float
+
+import os
+import numpy as np
+
+from .ultils import EstimatorBase, models_folder
+
+default_cache_folder = os.path.join(os.path.expanduser("~"), ".cache", "auto_labeling", "onnx")
+
+
+def export_onnx( model_version: int = 1, quantize: bool = False,
+                 cache_folder: Optional[str] = None, opset_version: int = 17 ) -> Tuple[str, str]:
+    """Exports scripted estimator model to ONNX, int8 dynamic quantized if quantize is set.
+    Files are cached in cache_folder and exported again only if the torch model is newer.
+    Returns paths of the ONNX model and of the metadata (npz) used by ONNXParametersEstimator.
+    """
+    cache_folder = cache_folder or default_cache_folder
+    source   = os.path.join(models_folder, f'PST_EST_model_scripted_v{model_version}.pt')
+    fp32     = os.path.join(cache_folder, f'PST_EST_model_v{model_version}.onnx')
+    int8     = os.path.join(cache_folder, f'PST_EST_model_v{model_version}_int8.onnx')
+    metadata = os.path.join(cache_folder, f'PST_EST_model_metadata_v{model_version}.npz')
+    target   = int8 if quantize else fp32
+
+    def fresh(path):
+        return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source)
+
+    if fresh(target) and fresh(metadata):
+        return target, metadata
+
+    os.makedirs(cache_folder, exist_ok=True)
+    if not (fresh(fp32) and fresh(metadata)):
+        _export_fp32(model_version, fp32, metadata, opset_version)
+    if quantize and not fresh(int8):
+        from onnxruntime.quantization import quantize_dynamic, QuantType # type: ignore
+        tmp = f"{int8}.{os.getpid()}.tmp.onnx"
+        quantize_dynamic(fp32, tmp, weight_type=QuantType.QInt8)
+        os.replace(tmp, int8)
+    return target, metadata
+
+def _export_fp32(model_version: int, path: str, metadata_path: str, opset_version: int) -> None:
+    import torch
+
+    model = torch.jit.load(os.path.join(models_folder, f'PST_EST_model_scripted_v{model_version}.pt'), map_location="cpu")
+    model.eval()
+    metadata = torch.load(os.path.join(models_folder, f'PST_EST_model_metadata_v{model_version}.pkl'))
+    shape = tuple(metadata['shape'])
+
+    tmp = f"{path}.{os.getpid()}.tmp.onnx"
+    torch.onnx.export( model, (torch.zeros((1, shape[2], shape[0], shape[1])),), tmp,
+                       input_names   = ["image"],
+                       output_names  = ["params"],
+                       dynamic_axes  = {"image": {0: "batch"}, "params": {0: "batch"}},
+                       opset_version = opset_version )
+    os.replace(tmp, path)
+
+    tmp = f"{metadata_path}.{os.getpid()}.tmp.npz"
+    np.savez( tmp,
+              shape      = np.array(shape),
+              shift      = np.array(metadata['shift'], dtype=np.float64),
+              gain       = np.array(metadata['gain'],  dtype=np.float64),
+              image_mean = np.asarray(metadata['image_mean'], dtype=np.float32).reshape(-1, 1, 1),
+              image_std  = np.asarray(metadata['image_std'],  dtype=np.float32).reshape(-1, 1, 1) )
+    os.replace(tmp, metadata_path)
+
+
+class ONNXParametersEstimator(EstimatorBase):
+    """Estimates PSTParameters like PSTParametersEstimator, running the model with onnxruntime on CPU.
+
+    Parameters
+    ----------
+    model_version : int
+        version of the model in auto_labeling/nn/models
+    quantize : bool
+        use int8 dynamic quantized model (faster, slightly less accurate)
+    intra_op_num_threads : int, optional
+        threads used inside operators, onnxruntime default (all cores) if None
+    cache_folder : str, optional
+        folder with exported models, ~/.cache/auto_labeling/onnx by default
+    """
+    def __init__( self, model_version: int = 1, quantize: bool = False,
+                  intra_op_num_threads: Optional[int] = None, cache_folder: Optional[str] = None ):
+        import onnxruntime as ort # type: ignore
+
+        model_path, metadata_path = export_onnx(model_version, quantize, cache_folder)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_num_threads is not None:
+            options.intra_op_num_threads = intra_op_num_threads
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+
+        with np.load(metadata_path) as metadata:
+            self._shape      = tuple(int(v) for v in metadata['shape'])
+            self._shift      = metadata['shift']
+            self._gain       = metadata['gain']
+            self._image_mean = metadata['image_mean']
+            self._image_std  = metadata['image_std']
+
+    def predict(self, patches: NDArray[Shape["*, *, *, *"], UInt8]) -> NDArray[Shape["*, 5"], Float]:
+        x = (patches.astype(np.float32) / 255 - self._image_mean) / self._image_std
+        return self.session.run(["params"], {"image": x})[0]
@@ -1,76 +1,181 @@
-from typing              import Any, Optional, Mapping
-from nptyping            import NDArray, Shape, Number
-from cv2.typing          import MatLike
+from __future__          import annotations
+
+from typing              import Any, Optional, Mapping, Tuple, Dict, TYPE_CHECKING
+from nptyping            import NDArray, Shape, Number, UInt8, Float
 from warnings            import warn
-from torch._prims_common import DeviceLikeType
+from dataclasses         import dataclass
+from abc                 import ABC, abstractmethod
 
-import torch
 import os
+import threading
 import numpy as np
 
 from ..guided import PSTParameters
 
+if TYPE_CHECKING:
+    from cv2.typing          import MatLike
+    from torch._prims_common import DeviceLikeType
+
 models_folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), "models")
 
-class PSTParametersEstimator:
-    def __init__(self, model_version: int = 1, torch_device: Optional[DeviceLikeType] = None):
-        self.model = torch.jit.load(os.path.join(models_folder, 
-                                            f'PST_EST_model_scripted_v{model_version}.pt'))
-        self.model.eval()
-        metadata = torch.load(os.path.join(models_folder, 
-                                            f'PST_EST_model_metadata_v{model_version}.pkl'))
-        self._shape = metadata['shape']
-        self._shift = np.array(metadata['shift'])
-        self._gain  = np.array(metadata['gain'])
-        self._image_mean = torch.Tensor(metadata['image_mean'])
-        self._image_std  = torch.Tensor(metadata['image_std'])
-
-        self._device = torch_device
-        if self._device is None:
-            self._device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.model.to(self._device)
-        self._image_mean = self._image_mean.to(self._device)
-        self._image_std  =  self._image_std.to(self._device)
-
-
-    def apply(self, image: MatLike, mask: Optional[MatLike] = None, n_samples: int = 10) -> PSTParameters:
-        img_shape = image.shape
-        def check_origin(origin, mask):
-            if(origin[0]+self._shape[0] >= img_shape[0] or origin[1]+self._shape[1] >= img_shape[1]):
-                return False
-            if not mask:
-                return True
-            partial_m = mask[origin[0] : (origin[0]+self._shape[0]), origin[1] : (origin[1]+self._shape[1])]
-            if((partial_m == 0).sum() > 0):
-                return False
-            return True
-        def slice_img(source, ii, jj):
-            return source[ii:(ii+self._shape[0]), jj:(jj+self._shape[1])]
-        
+
+@dataclass
+class LoadedModel:
+    """Scripted estimator model with its metadata, loaded on device and ready for inference"""
+    model:      Any
+    shape:      Tuple[int, ...]
+    shift:      NDArray
+    gain:       NDArray
+    image_mean: Any
+    image_std:  Any
+    device:     Any
+
+_models: Dict[Tuple[int, str], LoadedModel] = {}
+_models_lock = threading.Lock()
+
+def load_model( model_version: int = 1, torch_device: Optional[DeviceLikeType] = None,
+                optimize: bool = True, warmup: bool = True ) -> LoadedModel:
+    """Returns the estimator model for (model_version, device) from the process wide registry,
+    loading it on first use. Loaded models are frozen and optimized for inference when optimize
+    is set, and warmed up with one forward pass so the first real call has no compilation delay.
+    """
+    import torch
+
+    if torch_device is None:
+        torch_device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = torch.device(torch_device)
+    key    = (model_version, str(device))
+    with _models_lock:
+        loaded = _models.get(key)
+        if loaded is None:
+            loaded = _load_model(model_version, device, optimize, warmup)
+            _models[key] = loaded
+    return loaded
+
+def clear_models() -> None:
+    """Drops all models from the registry"""
+    with _models_lock:
+        _models.clear()
+
+def _load_model(model_version: int, device, optimize: bool, warmup: bool) -> LoadedModel:
+    import torch
+
+    model = torch.jit.load(os.path.join(models_folder, 
+                                        f'PST_EST_model_scripted_v{model_version}.pt'), map_location=device)
+    model.eval()
+    if optimize:
+        try:
+            model = torch.jit.optimize_for_inference(torch.jit.freeze(model))
+        except (RuntimeError, AttributeError) as e:
+            warn(f"TorchScript optimization of model v{model_version} failed, using it as loaded: {e}")
+    metadata = torch.load(os.path.join(models_folder, 
+                                        f'PST_EST_model_metadata_v{model_version}.pkl'))
+    loaded = LoadedModel( model      = model,
+                          shape      = tuple(metadata['shape']),
+                          shift      = np.array(metadata['shift']),
+                          gain       = np.array(metadata['gain']),
+                          image_mean = torch.Tensor(metadata['image_mean']).to(device),
+                          image_std  = torch.Tensor(metadata['image_std']).to(device),
+                          device     = device )
+    if warmup:
+        with torch.no_grad():
+            model(torch.zeros((1, loaded.shape[2], loaded.shape[0], loaded.shape[1]), device=device))
+    return loaded
+
+
+class EstimatorBase(ABC):
+    """Base of parameter estimators. Samples patches of the image, lets the model predict
+    raw parameters for them and returns median of the rescaled predictions.
+    Subclasses set _shape, _shift and _gain and implement predict.
+    """
+    _shape: Tuple[int, ...]
+    _shift: NDArray
+    _gain:  NDArray
+
+    @abstractmethod
+    def predict(self, patches: NDArray[Shape["*, *, *, *"], UInt8]) -> NDArray[Shape["*, 5"], Float]:
+        """raw model output for (B, C, h, w) stack of patches"""
+
+    def apply( self, image: MatLike, mask: Optional[MatLike] = None, n_samples: int = 10,
+               batch_size: int = 16 ) -> PSTParameters:
+        """Estimates PST parameters as median of estimates on n_samples random patches of image.
+        Patches lie entirely inside the non zero region of mask if it is given. All patches are
+        gathered at once and passed to the model in batches of batch_size, which bounds the memory
+        of the model input for large n_samples.
+        """
+        patches = self.sample_patches(image, mask, n_samples)
+
         estimated_params = np.zeros((n_samples, 5))
-        n_done = 0
-        n_failed = 0
-        while(n_done < n_samples):
-            if n_failed >= n_samples**3:
-                raise InterruptedError("Failed to extract samples, inconsistent data provided.")
-            ii, jj = np.random.default_rng().integers(0, max(img_shape), 2)
-            if not check_origin((ii, jj), mask):
-                n_failed += 1
-                continue
-            partial_img = slice_img(image, ii, jj)
-            x = (torch.Tensor(partial_img).to(self._device).permute(2, 0, 1) / 255 - self._image_mean)/self._image_std
-            with torch.no_grad():
-                self.model.eval()
-                estimated_params[n_done] = self.model(x).cpu().detach().numpy()
-
-            n_done += 1
+        for start in range(0, n_samples, batch_size):
+            batch = patches[start:start+batch_size]
+            estimated_params[start:start+len(batch)] = self.predict(batch)
 
         estimated_params = self._shift + estimated_params*self._gain
         res = np.median(estimated_params, axis=0)
         
         return PSTParameters(*res)
 
-    
+    def sample_patches( self, image: MatLike, mask: Optional[MatLike] = None,
+                        n_samples: int = 10 ) -> NDArray[Shape["*, *, *, *"], UInt8]:
+        """Returns (n_samples, C, h, w) stack of random patches of image"""
+        ii, jj = self._sample_origins(image.shape, mask, n_samples)
+        # (rows, cols, C, h, w) view of all patches, indexing copies only the sampled ones
+        windows = np.lib.stride_tricks.sliding_window_view(image, self._shape[:2], axis=(0, 1))
+        return windows[ii, jj]
+
+    def _sample_origins(self, img_shape, mask: Optional[MatLike], n_samples: int) -> Tuple[NDArray, NDArray]:
+        """Draws top-left corners of patches in bulk. With mask, candidates are kept only if
+        the patch has no zero pixel of mask, checked in O(1) per candidate with a summed-area table.
+        """
+        h, w = self._shape[:2]
+        n_rows, n_cols = img_shape[0] - h, img_shape[1] - w
+        if n_rows <= 0 or n_cols <= 0:
+            raise ValueError(f"Image of shape {img_shape[:2]} is smaller than model input {(h, w)}.")
 
+        rng = np.random.default_rng()
+        if mask is None:
+            return rng.integers(0, n_rows, n_samples), rng.integers(0, n_cols, n_samples)
+
+        outside = np.asarray(mask) == 0
+        if outside.ndim == 3:
+            outside = outside.any(axis=2)
+        sat = np.zeros((img_shape[0] + 1, img_shape[1] + 1), dtype=np.int64)
+        sat[1:, 1:] = outside.cumsum(axis=0).cumsum(axis=1)
+
+        rows, cols = [], []
+        n_done, n_drawn = 0, 0
+        while n_done < n_samples:
+            if n_drawn >= n_samples**3:
+                raise InterruptedError("Failed to extract samples, inconsistent data provided.")
+            n_candidates = max(4 * n_samples, 1024)
+            ii = rng.integers(0, n_rows, n_candidates)
+            jj = rng.integers(0, n_cols, n_candidates)
+            zeros = sat[ii + h, jj + w] - sat[ii, jj + w] - sat[ii + h, jj] + sat[ii, jj]
+            ok = zeros == 0
+            rows.append(ii[ok]); cols.append(jj[ok])
+            n_done  += int(ok.sum())
+            n_drawn += n_candidates
+        return np.concatenate(rows)[:n_samples], np.concatenate(cols)[:n_samples]
+
+
+class PSTParametersEstimator(EstimatorBase):
+    """Estimates PSTParameters of image with a pre-trained convolutional network.
+    Models are shared through load_model, so constructing estimators is cheap.
+    """
+    def __init__(self, model_version: int = 1, torch_device: Optional[DeviceLikeType] = None):
+        loaded = load_model(model_version, torch_device)
+        self.model       = loaded.model
+        self._shape      = loaded.shape
+        self._shift      = loaded.shift
+        self._gain       = loaded.gain
+        self._image_mean = loaded.image_mean
+        self._image_std  = loaded.image_std
+        self._device     = loaded.device
 
+    def predict(self, patches: NDArray[Shape["*, *, *, *"], UInt8]) -> NDArray[Shape["*, 5"], Float]:
+        import torch
 
+        with torch.no_grad():
+            x = torch.from_numpy(np.ascontiguousarray(patches)).to(self._device).float()
+            x = (x / 255 - self._image_mean)/self._image_std
+            return self.model(x).cpu().numpy()
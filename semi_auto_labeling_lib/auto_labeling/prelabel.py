@@ -0,0 +1,235 @@
+"""Headless batch pre-labeling.
+Walks a dataset folder and writes draft vessel masks to <image folder>/VesselMasks/<name>_V.png,
+the layout OptiLabel reads. Images that already have a mask are skipped, so an interrupted run
+can be resumed by running the same command again.
+
+    python -m auto_labeling.prelabel DATASET --workers 4 --backend numpy
+"""
+from __future__  import annotations
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses        import dataclass
+from typing             import Iterator, List, Optional, Tuple
+
+import argparse
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tif", ".tiff")
+MASK_FOLDERS     = ("VesselMasks", "Macula", "Optical")
+
+
+@dataclass
+class PrelabelOptions:
+    """Options of the pre-labeling pipeline, passed once to every worker process"""
+    backend:       str   = "torch"
+    torch_device:  Optional[str] = None
+    threads:       int   = 1
+    estimator:     str   = "torch"
+    n_samples:     int   = 10
+    params:        Optional[Tuple[float, float, float, float, float]] = None
+    thresh_px:     int   = 25
+    ksize_closing: int   = 15
+    ksize_median:  int   = 7
+    thresh_px_2:   int   = 100
+    cache_folder:  Optional[str] = None
+
+
+def mask_path(image_path: str) -> str:
+    folder, name = os.path.split(image_path)
+    return os.path.join(folder, "VesselMasks", os.path.splitext(name)[0] + "_V.png")
+
+def find_images(root: str, recursive: bool = True) -> Iterator[str]:
+    """Yields image paths under root in sorted order, mask folders are skipped"""
+    for folder, subfolders, files in os.walk(root):
+        subfolders[:] = sorted(s for s in subfolders if recursive and s not in MASK_FOLDERS)
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(folder, name)
+
+def write_atomic(path: str, data: bytes) -> None:
+    """Writes data to a temporary file and renames it over path, readers never see a partial mask"""
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    tmp = os.path.join(folder, f".{os.path.basename(path)}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+# per worker state, created once by _init_worker
+_labeler   = None
+_estimator = None
+_options: Optional[PrelabelOptions] = None
+
+def _init_worker(options: PrelabelOptions) -> None:
+    global _labeler, _estimator, _options
+    from .guided import PSTLabeler, PSTParameters, NumpyPSTBackend, PSTResultCache
+
+    _options = options
+    cache = PSTResultCache(options.cache_folder) if options.cache_folder else None
+    if options.backend == "numpy":
+        _labeler = PSTLabeler(backend=NumpyPSTBackend(workers=options.threads), result_cache=cache)
+    else:
+        import torch
+        torch.set_num_threads(options.threads)
+        _labeler = PSTLabeler(torch_device=options.torch_device, result_cache=cache)
+
+    if options.params is not None:
+        _labeler.set_params(PSTParameters(*options.params))
+    elif options.estimator == "onnx":
+        from .nn import ONNXParametersEstimator
+        _estimator = ONNXParametersEstimator(intra_op_num_threads=options.threads)
+    else:
+        from .nn import PSTParametersEstimator
+        _estimator = PSTParametersEstimator(torch_device=options.torch_device)
+
+def _process(path: str, data: bytes) -> Tuple[str, float, Optional[str]]:
+    """Labels one encoded image, returns (path, seconds, error)"""
+    import cv2
+    import numpy as np
+
+    assert _labeler is not None and _options is not None, "worker is not initialized"
+    start = time.perf_counter()
+    try:
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("cannot decode image")
+        if _estimator is not None:
+            _labeler.set_params(_estimator.apply(image, n_samples=_options.n_samples))
+        result = _labeler.apply(image)
+        result.denoise(thresh_px=_options.thresh_px) \
+              .mask_reconstruction(_options.ksize_closing, _options.ksize_median) \
+              .denoise(thresh_px=_options.thresh_px_2)
+        ok, png = cv2.imencode(".png", result.edges, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        if not ok:
+            raise ValueError("cannot encode mask")
+        write_atomic(mask_path(path), png.tobytes())
+    except Exception as e:
+        return path, time.perf_counter() - start, f"{type(e).__name__}: {e}"
+    return path, time.perf_counter() - start, None
+
+
+def _read_ahead(paths: List[str], buffer: queue.Queue, stop: threading.Event) -> None:
+    """Reads files into the bounded buffer, None marks the end"""
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                item = (path, f.read())
+        except OSError as e:
+            item = (path, e)
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        if stop.is_set():
+            return
+    buffer.put(None)
+
+def prelabel( root: str, options: PrelabelOptions, workers: int = 1, prefetch: int = 8,
+              recursive: bool = True, overwrite: bool = False, log=print ) -> Tuple[int, int, int]:
+    """Pre-labels all images under root. Returns counts of (labeled, skipped, failed) images.
+    File reading runs in a thread ahead of the workers, at most prefetch images are buffered
+    and at most 2 * workers are in flight, so memory stays bounded on large datasets.
+    """
+    paths   = list(find_images(root, recursive))
+    todo    = paths if overwrite else [p for p in paths if not os.path.exists(mask_path(p))]
+    skipped = len(paths) - len(todo)
+    log(f"{len(paths)} images, {skipped} already labeled, {len(todo)} to label with {workers} workers")
+    if not todo:
+        return 0, skipped, 0
+
+    buffer: queue.Queue = queue.Queue(maxsize=prefetch)
+    stop   = threading.Event()
+    reader = threading.Thread(target=_read_ahead, args=(todo, buffer, stop), daemon=True)
+    reader.start()
+
+    done, failed = 0, 0
+    start = time.perf_counter()
+    try:
+        # spawn: forked workers would inherit torch/CUDA state of the parent
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=(options,)) as pool:
+            in_flight: set = set()
+            exhausted = False
+            while in_flight or not exhausted:
+                while not exhausted and len(in_flight) < 2 * workers:
+                    item = buffer.get()
+                    if item is None:
+                        exhausted = True
+                    elif isinstance(item[1], OSError):
+                        failed += 1
+                        log(f"failed {item[0]}: {item[1]}")
+                    else:
+                        in_flight.add(pool.submit(_process, *item))
+                if not in_flight:
+                    continue
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    path, seconds, error = future.result()
+                    if error is None:
+                        done += 1
+                    else:
+                        failed += 1
+                        log(f"failed {path}: {error}")
+                    elapsed = time.perf_counter() - start
+                    rate    = (done + failed) / elapsed
+                    eta     = (len(todo) - done - failed) / rate if rate else 0
+                    log(f"[{done + failed}/{len(todo)}] {os.path.basename(path)} {seconds:.2f} s, "
+                        f"{rate:.2f} img/s, eta {eta:.0f} s")
+    finally:
+        stop.set()
+
+    elapsed = time.perf_counter() - start
+    log(f"labeled {done}, failed {failed}, skipped {skipped} in {elapsed:.1f} s ({done / elapsed:.2f} img/s)")
+    return done, skipped, failed
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m auto_labeling.prelabel", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root", help="dataset folder")
+    parser.add_argument("--workers",   type=int, default=max(1, (os.cpu_count() or 1) // 2), help="worker processes")
+    parser.add_argument("--threads",   type=int, default=1, help="compute threads per worker")
+    parser.add_argument("--prefetch",  type=int, default=8, help="images read ahead of the workers")
+    parser.add_argument("--backend",   choices=["torch", "numpy"], default="torch", help="PST backend")
+    parser.add_argument("--device",    default=None, help="torch device, e.g. cpu or cuda:0")
+    parser.add_argument("--estimator", choices=["torch", "onnx"], default="torch", help="parameter estimator")
+    parser.add_argument("--n-samples", type=int, default=10, help="patches per image for parameter estimation")
+    parser.add_argument("--params",    type=float, nargs=5, default=None,
+                        metavar=("S", "W", "SIGMA_LPF", "THRESH_MIN", "THRESH_MAX"),
+                        help="fixed PST parameters instead of estimation")
+    parser.add_argument("--thresh-px", type=int, default=25,  help="denoise threshold before reconstruction")
+    parser.add_argument("--thresh-px-final", type=int, default=100, help="denoise threshold after reconstruction")
+    parser.add_argument("--cache",     default=None, metavar="FOLDER",
+                        help="cache PST outputs in FOLDER, reruns with other denoise thresholds skip the transform")
+    parser.add_argument("--no-recursive", action="store_true", help="do not descend into subfolders")
+    parser.add_argument("--overwrite",    action="store_true", help="relabel images which already have a mask")
+    args = parser.parse_args(argv)
+
+    options = PrelabelOptions( backend      = args.backend,
+                               torch_device = args.device,
+                               threads      = args.threads,
+                               estimator    = args.estimator,
+                               n_samples    = args.n_samples,
+                               params       = tuple(args.params) if args.params else None,
+                               thresh_px    = args.thresh_px,
+                               thresh_px_2  = args.thresh_px_final,
+                               cache_folder = args.cache )
+    _, _, failed = prelabel( args.root, options, workers=args.workers, prefetch=args.prefetch,
+                             recursive=not args.no_recursive, overwrite=args.overwrite )
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,53 @@
+"""Accuracy vs latency of parameter estimator backends.
+All backends predict on the same patches of the example image, the torch model is the reference.
+
+    python examples/estimator_benchmark.py --samples 32 --threads 4
+"""
+import argparse
+import os
+import time
+
+import cv2 as cv
+import numpy as np
+
+from auto_labeling.nn import PSTParametersEstimator, ONNXParametersEstimator
+
+script_folder = os.path.dirname(os.path.realpath(__file__))
+img_path = os.path.join(script_folder, "resources", "example.jpg")
+
+names = ["phase_strength", "warp_strength", "sigma_LPF", "thresh_min", "thresh_max"]
+
+def timed(estimator, patches, repeat):
+    estimator.predict(patches[:1])
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        raw = estimator.predict(patches)
+        times.append(time.perf_counter() - t0)
+    return estimator._shift + raw*estimator._gain, np.median(times)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, default=32)
+    parser.add_argument("--repeat",  type=int, default=5)
+    parser.add_argument("--threads", type=int, default=None, help="onnxruntime intra-op threads")
+    args = parser.parse_args()
+
+    image = cv.imread(img_path)
+    reference = PSTParametersEstimator(torch_device="cpu")
+    patches = reference.sample_patches(image, n_samples=args.samples)
+
+    backends = { "torch":     reference,
+                 "onnx fp32": ONNXParametersEstimator(intra_op_num_threads=args.threads),
+                 "onnx int8": ONNXParametersEstimator(quantize=True, intra_op_num_threads=args.threads) }
+
+    ref_params, _ = timed(reference, patches, 1)
+    print(f"{'backend':10s} {'ms/patch':>9s}  " + "  ".join(f"{n:>14s}" for n in names))
+    for name, estimator in backends.items():
+        params, seconds = timed(estimator, patches, args.repeat)
+        # mean absolute difference of the rescaled parameters from the torch model
+        errors = np.abs(params - ref_params).mean(axis=0)
+        print(f"{name:10s} {1000*seconds/len(patches):9.2f}  " + "  ".join(f"{e:14.4g}" for e in errors))
+
+if __name__ == "__main__":
+    main()
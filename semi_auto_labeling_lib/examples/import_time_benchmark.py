@@ -0,0 +1,51 @@
+"""Cold start benchmark of auto_labeling imports.
+Every module is imported in a fresh interpreter, the best of --repeat runs is compared to --budget
+and heavy dependencies must not be loaded by the import itself. Exits with status 1 on failure,
+so it can guard import latency in CI:
+
+    python examples/import_time_benchmark.py --budget 0.5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+MODULES = ["auto_labeling", "auto_labeling.guided", "auto_labeling.nn"]
+HEAVY   = ["torch", "phycv", "sklearn", "cv2", "pipe", "scipy", "onnxruntime"]
+
+PROBE = """
+import sys, time, json
+t0 = time.perf_counter()
+import {module}
+t1 = time.perf_counter()
+print(json.dumps({{"seconds": t1 - t0, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+lib_folder = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+def probe(module):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [lib_folder, env.get("PYTHONPATH")]))
+    out = subprocess.run( [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY)],
+                          env=env, capture_output=True, text=True, check=True )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget", type=float, default=0.5, help="maximal import time in seconds")
+    parser.add_argument("--repeat", type=int,   default=5,   help="fresh interpreters per module")
+    args = parser.parse_args()
+
+    failed = False
+    for module in MODULES:
+        runs    = [probe(module) for _ in range(args.repeat)]
+        seconds = min(r["seconds"] for r in runs)
+        heavy   = sorted(set(m for r in runs for m in r["heavy"]))
+        ok      = seconds <= args.budget and not heavy
+        failed |= not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {module:24s} {1000*seconds:8.1f} ms" + (f"  loads {', '.join(heavy)}" if heavy else ""))
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import cv2 as cv
+import os
+import time
+
+import auto_labeling.guided as alg
+
+# Interactive tuning of PST parameters with trackbars.
+# While sliders move, PST of a downsampled image is shown, the full resolution
+# result replaces it as soon as the background refinement of the last parameters is done.
+
+# preview image size
+psize = 1200
+
+script_folder = os.path.dirname(os.path.realpath(__file__))
+img_path = os.path.join(script_folder, "resources", "example.jpg")
+
+def resize_preview(img):
+    return cv.resize(img, (psize, int(psize*img.shape[0]/img.shape[1])), interpolation=cv.INTER_AREA)
+
+# trackbar name: (initial position, maximum, position -> parameter value)
+trackbars = { "phase_strength": (20,  100,  lambda v: float(v)),
+              "warp_strength" : (400, 1000, lambda v: float(v)),
+              "sigma_LPF"     : (10,  100,  lambda v: max(v, 1) / 100),
+              "thresh_min"    : (5,   100,  lambda v: v / 100),
+              "thresh_max"    : (75,  100,  lambda v: v / 100) }
+
+def read_params():
+    return { name: to_value(cv.getTrackbarPos(name, "tuning"))
+             for name, (_, _, to_value) in trackbars.items() }
+
+image = cv.imread(img_path)
+preview = alg.ProgressivePSTPreview(backend="numpy", preview_size=512)
+preview.set_image(image)
+
+cv.namedWindow("tuning", flags=cv.WINDOW_AUTOSIZE | cv.WINDOW_KEEPRATIO | cv.WINDOW_GUI_NORMAL)
+for name, (initial, maximum, _) in trackbars.items():
+    cv.createTrackbar(name, "tuning", initial, maximum, lambda v: None)
+
+params, shown = None, None
+frames, t0 = 0, time.perf_counter()
+while cv.getWindowProperty("tuning", cv.WND_PROP_VISIBLE):
+    current = read_params()
+    if current != params:
+        params = current
+        shown  = preview.update(params)
+        frames += 1
+    refined = preview.refined
+    if refined is not None and shown is not None and not shown.final:
+        shown = refined
+    if shown is not None:
+        cv.imshow("tuning", resize_preview(shown.result.edges))
+    if time.perf_counter() - t0 > 1:
+        print(f"{frames / (time.perf_counter() - t0):.1f} previews/s, {'full resolution' if shown and shown.final else 'preview'} {params}")
+        frames, t0 = 0, time.perf_counter()
+    cv.waitKey(15)
+
+preview.close()
+cv.destroyAllWindows()
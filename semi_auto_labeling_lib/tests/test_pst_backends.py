@@ -0,0 +1,146 @@
+"""Parity of PST backends with a NumPy port of phycv's PST (phycv/pst.py, phycv/utils.py).
+Run from semi_auto_labeling_lib with python -m pytest tests
+"""
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from auto_labeling.guided import NumpyPSTBackend, PSTBackendBase, PSTLabeler, PSTParameters, TiledPSTBackend
+
+image_path = os.path.join(os.path.dirname(__file__), "..", "examples", "resources", "example.jpg")
+
+
+def phycv_pst(img, S, W, sigma_LPF, thresh_min, thresh_max, morph_flag):
+    """phycv's PST.init_kernel and PST.apply_kernel"""
+    h, w = img.shape
+    u = np.linspace(-0.5, 0.5, h)
+    v = np.linspace(-0.5, 0.5, w)
+    U, V = np.meshgrid(u, v, indexing="ij")
+    rho = np.sqrt(U**2 + V**2)
+    kernel = W * rho * np.arctan(W * rho) - 0.5 * np.log(1 + (W * rho) ** 2)
+    kernel = S * kernel / np.max(kernel)
+
+    expo = np.fft.fftshift(np.exp(-0.5 * np.power(rho / np.sqrt(sigma_LPF**2 / np.log(2)), 2)))
+    denoised = np.real(np.fft.ifft2(np.fft.fft2(img) * expo))
+    feature = np.angle(np.fft.ifft2(np.fft.fft2(denoised) * np.fft.fftshift(np.exp(-1j * kernel))))
+    feature = (feature - feature.min()) / (feature.max() - feature.min())
+    if not morph_flag:
+        return feature
+
+    quantile_max = np.quantile(feature[::4, ::4], thresh_max)
+    quantile_min = np.quantile(feature[::4, ::4], thresh_min)
+    digital = np.zeros(feature.shape)
+    digital[feature > quantile_max] = 1
+    digital[feature < quantile_min] = 1
+    digital[img < np.amax(img) / 20] = 0
+    return digital.astype(np.float32)
+
+
+@pytest.fixture(scope="module")
+def image():
+    img = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    return cv2.resize(img, (img.shape[1] // 4, img.shape[0] // 4), interpolation=cv2.INTER_AREA)
+
+
+@pytest.mark.parametrize("S, W, sigma_LPF", [(20, 400, 0.1), (20, 400, 0.3), (0.5, 20, 0.2)])
+def test_numpy_phase_matches_phycv(image, S, W, sigma_LPF):
+    backend = NumpyPSTBackend()
+    backend.set_params(PSTParameters(S, W, sigma_LPF, None, None, morph_flag=False))
+    phase     = backend.transform(image[None])[0]
+    reference = phycv_pst(image.astype(np.float64), S, W, sigma_LPF, None, None, False)
+
+    assert phase.min() == pytest.approx(0) and phase.max() == pytest.approx(1)
+    # one merged filter instead of phycv's low-pass, real part and PST kernel moves the extremes slightly
+    assert np.mean(np.abs(phase - reference)) < 5e-3
+
+
+@pytest.mark.parametrize("S, W, sigma_LPF", [(20, 400, 0.1), (20, 400, 0.3), (0.5, 20, 0.2)])
+def test_numpy_mask_matches_phycv(image, S, W, sigma_LPF):
+    backend = NumpyPSTBackend()
+    backend.set_params(PSTParameters(S, W, sigma_LPF, 0.05, 0.75))
+    mask      = backend.transform(image[None])[0]
+    reference = phycv_pst(image.astype(np.float64), S, W, sigma_LPF, 0.05, 0.75, True)
+
+    # only pixels with phase close to a quantile can flip
+    assert np.mean(mask != reference) < 0.005
+
+
+class NormalizingBackend(PSTBackendBase):
+    name = "normalizing"
+
+    def transform(self, images):
+        return np.zeros(images.shape, dtype=np.float32)
+
+
+def test_tiled_requires_raw_phase():
+    with pytest.raises(ValueError):
+        TiledPSTBackend(NormalizingBackend())
+
+
+def test_tiled_normalizes_blended_phase(image):
+    params = PSTParameters(20, 400, 0.1, None, None, morph_flag=False)
+    untiled = NumpyPSTBackend()
+    untiled.set_params(params)
+    tiled = TiledPSTBackend(NumpyPSTBackend(), tile_size=256, halo=128)
+    tiled.set_params(params)
+    phase     = tiled.transform(image[None])[0]
+    reference = untiled.transform(image[None])[0]
+
+    assert phase.min() == pytest.approx(0) and phase.max() == pytest.approx(1)
+    # borders are reflected by the tiles but wrap around in the untiled FFT, which also shifts the extremes
+    inner = np.s_[64:-64, 64:-64]
+    assert np.corrcoef(phase[inner].ravel(), reference[inner].ravel())[0, 1] > 0.99
+
+
+@pytest.mark.parametrize("S, W, sigma_LPF", [(20, 400, 0.1), (20, 400, 0.3), (0.5, 20, 0.2)])
+def test_tiled_seams_match_untiled(image, S, W, sigma_LPF):
+    params = PSTParameters(S, W, sigma_LPF, 0.05, 0.75)
+    untiled = NumpyPSTBackend()
+    untiled.set_params(params)
+    reference = untiled.transform(image[None])[0]
+
+    # borders excluded as in test_tiled_normalizes_blended_phase. Tiles cannot match exactly, phycv's
+    # frequency grid (linspace over the transformed shape) makes the kernel depend on the shape slightly
+    inner    = np.s_[64:-64, 64:-64]
+    mismatch = {}
+    for halo in (32, None):
+        tiled = TiledPSTBackend(NumpyPSTBackend(), tile_size=256, halo=halo)
+        tiled.set_params(params)
+        mismatch[halo] = np.mean(tiled.transform(image[None])[0][inner] != reference[inner])
+
+    assert mismatch[None] < 0.0125
+    assert mismatch[None] < mismatch[32]
+
+
+@pytest.mark.parametrize("backend", ["numpy", "torch"])
+def test_apply_batch_matches_apply_without_morphology(image, backend):
+    if backend == "torch":
+        pytest.importorskip("torch")
+        pytest.importorskip("phycv")
+    labeler = PSTLabeler(backend=backend)
+    labeler.set_params(PSTParameters(20, 400, 0.1, None, None, morph_flag=False))
+    # images of different contrast, a normalization over the stack would change the darker one
+    images  = [image, image // 4, np.ascontiguousarray(image[::-1])]
+
+    batch = labeler.apply_batch(images, flag_raw=True)
+    for result, img in zip(batch, images):
+        np.testing.assert_allclose(result.edges, labeler.apply(img, flag_raw=True).edges, atol=1e-5)
+
+
+def test_torch_mask_matches_phycv(image):
+    torch = pytest.importorskip("torch")
+    phycv = pytest.importorskip("phycv")
+    params = PSTParameters(20, 400, 0.1, 0.05, 0.75)
+    labeler = PSTLabeler(torch_device="cpu", backend="torch")
+    labeler.set_params(params)
+    mask = labeler.apply(image, flag_raw=True).edges
+
+    pst = phycv.PST_GPU(device=torch.device("cpu"))
+    pst.load_img(img_array=torch.from_numpy(image))
+    pst.init_kernel(params.phase_strength, params.warp_strength)
+    pst.apply_kernel(params.sigma_LPF, params.thresh_min, params.thresh_max, True)
+
+    # kthvalue interpolates quantiles as torch.quantile does, only float rounding may differ
+    assert np.mean(mask != pst.pst_output.numpy()) < 1e-4
@@ -0,0 +1,63 @@
+"""PSTResultCache keys and eviction.
+Run from semi_auto_labeling_lib with python -m pytest tests
+"""
+import os
+
+import numpy as np
+
+from auto_labeling.guided import NumpyPSTBackend, PSTLabeler, PSTParameters, PSTResultCache
+
+
+def test_key_without_morphology():
+    image  = np.arange(64, dtype=np.uint8).reshape(8, 8)
+    raw    = PSTParameters(20, 400, 0.1, None, None, morph_flag=False)
+    morph  = PSTParameters(20, 400, 0.1, 0.05, 0.75)
+
+    assert PSTResultCache.key(image, raw, "numpy/2") != PSTResultCache.key(image, morph, "numpy/2")
+    assert PSTResultCache.key(image, raw, "numpy/2") == \
+           PSTResultCache.key(image, {**raw.__dict__, "phase_strength": 20.0}, "numpy/2")
+
+
+def test_labeler_caches_raw_phase(tmp_path):
+    image   = np.random.default_rng(0).integers(0, 255, (64, 96), dtype=np.uint8)
+    cache   = PSTResultCache(str(tmp_path))
+    labeler = PSTLabeler(backend=NumpyPSTBackend(), result_cache=cache)
+    labeler.set_params(PSTParameters(20, 400, 0.1, None, None, morph_flag=False))
+
+    first  = labeler.apply(image, flag_raw=True)
+    second = labeler.apply(image, flag_raw=True)
+    assert (cache.hits, cache.misses) == (1, 1)
+    np.testing.assert_array_equal(first.edges, second.edges)
+
+
+def test_evict_skips_files_in_flight(tmp_path, monkeypatch):
+    writer  = PSTResultCache(str(tmp_path))
+    evictor = PSTResultCache(str(tmp_path), max_bytes=1)
+    replace = os.replace
+
+    def evict_then_replace(src, dst):
+        # another process sharing the folder evicts while the entry is being written
+        evictor.evict()
+        replace(src, dst)
+
+    monkeypatch.setattr(os, "replace", evict_then_replace)
+    writer.put("a" * 64, np.zeros((8, 8), dtype=np.float32))
+    assert os.path.exists(writer.path("a" * 64))
+
+
+def test_corrupted_entry_is_dropped(tmp_path):
+    cache = PSTResultCache(str(tmp_path))
+    key   = "b" * 64
+    cache.put(key, np.zeros((8, 8), dtype=np.float32))
+    with open(cache.path(key), "r+b") as f:
+        f.truncate(16)
+
+    assert cache.get(key) is None
+    assert not os.path.exists(cache.path(key))
+
+
+def test_overwrite_counts_entry_once(tmp_path):
+    cache = PSTResultCache(str(tmp_path))
+    for _ in range(3):
+        cache.put("c" * 64, np.zeros((8, 8), dtype=np.float32))
+    assert cache.total_bytes == os.path.getsize(cache.path("c" * 64))
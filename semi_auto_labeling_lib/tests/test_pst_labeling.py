@@ -0,0 +1,58 @@
+"""PSTResult.denoise methods.
+Run from semi_auto_labeling_lib with python -m pytest tests
+"""
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from auto_labeling.guided import NumpyPSTBackend, PSTLabeler, PSTParameters, PSTResult
+
+image_path = os.path.join(os.path.dirname(__file__), "..", "examples", "resources", "example.jpg")
+
+
+def denoised(mask, method, **kwargs):
+    return PSTResult(mask.copy()).denoise(method=method, **kwargs).edges
+
+
+def test_runs_farther_than_eps_are_separate_clusters():
+    mask = np.zeros((9, 20), dtype=np.uint8)
+    mask[4, 2:7]  = 255
+    mask[4, 9:14] = 255  # 3 px from the first run, eps is 2
+
+    for method in ("components", "dbscan"):
+        assert not denoised(mask, method, thresh_px=8, eps_px=2).any()
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("eps_px", [1, 2, 3])
+def test_components_match_dbscan_on_random_masks(seed, eps_px):
+    rng  = np.random.default_rng(seed)
+    mask = (rng.random((60, 80)) < 0.15).astype(np.uint8) * 255
+    np.testing.assert_array_equal( denoised(mask, "components", thresh_px=10, eps_px=eps_px),
+                                   denoised(mask, "dbscan",     thresh_px=10, eps_px=eps_px) )
+
+
+@pytest.mark.parametrize("thresh_px", [25, 300])
+def test_components_match_dbscan_on_pst_mask(thresh_px):
+    image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    image = cv2.resize(image, (image.shape[1] // 4, image.shape[0] // 4), interpolation=cv2.INTER_AREA)
+    labeler = PSTLabeler(backend=NumpyPSTBackend())
+    labeler.set_params(PSTParameters(20, 400, 0.1, 0.05, 0.75))
+    mask = labeler.apply(image).edges
+
+    np.testing.assert_array_equal( denoised(mask, "components", thresh_px=thresh_px),
+                                   denoised(mask, "dbscan",     thresh_px=thresh_px) )
+
+
+@pytest.mark.parametrize("point", [(-1, -1), (0, -1), (20, 0), (0, 9)])
+def test_extract_rejects_points_outside(point):
+    mask = np.zeros((9, 20), dtype=np.uint8)
+    mask[4, 2:7] = 255
+    result = PSTResult(mask)
+
+    with pytest.raises(IndexError):
+        result.extract_at_many([(3, 4), point])
+    with pytest.raises(IndexError):
+        result.extract_crop_at(*point)